@@ -3,29 +3,32 @@
 #Created by Maria Kalendarova and Kaloian Piperkov
 
 
+#the google client libraries, the OAuth flow, webbrowser and the email.mime classes are imported
+#where they are first used, so the inbox can be on screen before they have loaded
+
 import os       #provides access to os-specific functionality
-import json     # handling of JSON data
+import logging  #failed background refreshes are logged instead of shown in a dialog
+import time     #startup timing
+from collections import OrderedDict     #bounded header cache of the inbox list
 import wx       #gui    
-from google.oauth2.credentials import Credentials       #handling OAuth 2.0 credentials for google APIs
-from google_auth_oauthlib.flow import InstalledAppFlow  #implementing the OAuth 2.0 aouthorization flow
-from googleapiclient.discovery import build             #builing a google API service
-from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
-from email import message_from_string 
-from email.header import decode_header
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email.mime.application import MIMEApplication
-from email.message import EmailMessage
-from email import encoders
-import base64                   #encoding and decoding base64 data
-import webbrowser               #opening url's in the user's browser
-from bs4 import BeautifulSoup   #html parsing library for extracting content from email bodies
+import tempfile                 #spooling large outgoing emails to disk
+import shutil                   #copying downloaded attachments where the user saves them
+from gmail_fetch import BATCH_SIZE, get_email_address   #rows whose headers are fetched together
+from mail_sync import full_sync, incremental_sync, load_headers, load_message   #keeping the local store in step with gmail
+from gmail_session import GmailSession, SCOPES, save_token, default_pool   #authorized Gmail clients over shared connections
+from accounts import Account, RefreshSchedule, load_accounts, register_account, open_session, merge_ids   #several accounts in one window
+from background import default_worker, check_cancelled   #runs Gmail API calls off the ui thread
+from bulk_export import export_mailbox   #headless mailbox export
+from mail_merge import read_recipients, send_campaign, merge_log_path   #one email to every recipient of a csv file
+from mime_stream import build_raw_message, is_large_message, write_message, send_message_stream   #streaming, resumable sends
+from rate_limit import default_scheduler   #gmail quota and retries of rate limited requests
+from mail_attachments import format_size   #attachments downloaded on demand
+from metrics import metrics, configure_logging, dump_file, log_event   #timings, counters and cache hit rates
 
 #viewing content of emails
 class EmailViewer(wx.Frame):
-    def __init__(self, parent, title, email_content):
+    def __init__(self, parent, title, email_content, message_id=None, attachments=(), account=None, worker=None):
         super(EmailViewer, self).__init__(parent, title=title, size=(600, 400))
 
         self.panel = wx.Panel(self)
@@ -35,20 +38,224 @@ class EmailViewer(wx.Frame):
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(self.email_content, 1, wx.EXPAND | wx.ALL, 5)
 
+        #attachments are only listed, each one is downloaded when it is opened or saved
+        self.message_id = message_id
+        self.attachments = list(attachments)
+        #the account the email belongs to, its session is looked up when a download starts
+        #since the email may be opened from the store before the account has connected
+        self.account = account
+        self.worker = worker
+        if self.attachments:
+            self.attachment_list = wx.ListCtrl(self.panel, style=wx.LC_REPORT | wx.LC_SINGLE_SEL | wx.BORDER_THEME,
+                                               size=(-1, 110))
+            self.attachment_list.InsertColumn(0, "Attachment", width=300)
+            self.attachment_list.InsertColumn(1, "Type", width=150)
+            self.attachment_list.InsertColumn(2, "Size", width=100)
+            for index, attachment in enumerate(self.attachments):
+                self.attachment_list.InsertItem(index, attachment['filename'])
+                self.attachment_list.SetItem(index, 1, attachment['mime_type'])
+                self.attachment_list.SetItem(index, 2, format_size(attachment['size']))
+            self.attachment_list.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.on_open_attachment)
+
+            self.open_button = wx.Button(self.panel, label="Open")
+            self.open_button.Bind(wx.EVT_BUTTON, self.on_open_attachment)
+            self.save_button = wx.Button(self.panel, label="Save As...")
+            self.save_button.Bind(wx.EVT_BUTTON, self.on_save_attachment)
+            self.attachment_status = wx.StaticText(self.panel, label="")
+
+            buttons = wx.BoxSizer(wx.HORIZONTAL)
+            buttons.Add(self.open_button, 0, wx.ALL, 5)
+            buttons.Add(self.save_button, 0, wx.ALL, 5)
+            buttons.Add(self.attachment_status, 1, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+            sizer.Add(self.attachment_list, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 5)
+            sizer.Add(buttons, 0, wx.EXPAND)
+
         self.panel.SetSizer(sizer)
         self.Centre()
         self.Show()
 
-#viewing the inbox emails, refreshing emails, option to send emails
+    def selected_attachment(self):
+        index = self.attachment_list.GetFirstSelected()
+        if index == -1:
+            wx.MessageBox("Please select an attachment.", "Error", wx.OK | wx.ICON_ERROR)
+            return None
+        return self.attachments[index]
+
+    def on_open_attachment(self, event):
+        attachment = self.selected_attachment()
+        if attachment is not None:
+            self.download(attachment, on_success=self.on_attachment_opened)
+
+    def on_save_attachment(self, event):
+        attachment = self.selected_attachment()
+        if attachment is None:
+            return
+        with wx.FileDialog(self, "Save attachment", defaultFile=attachment['filename'],
+                           style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dialog:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            destination = dialog.GetPath()
+        self.download(attachment, destination, on_success=self.on_attachment_saved)
+
+    def download(self, attachment, destination=None, on_success=None):
+        #served from the attachment cache when it has been downloaded before
+        account = self.account
+        downloaded = os.path.exists(account.attachment_cache.path(self.message_id, attachment))
+        if account.session is None and 'data' not in attachment and not downloaded:
+            wx.MessageBox(f"Still connecting to Gmail for {account.email}, please try again in a moment.",
+                          "Info", wx.OK | wx.ICON_INFORMATION)
+            return
+        self.attachment_status.SetLabel(f"Downloading {attachment['filename']}...")
+        self.worker.submit(self.fetch_attachment, account.session, attachment, destination,
+                           on_success=on_success, on_error=self.on_attachment_error, owner=self)
+
+    def fetch_attachment(self, session, attachment, destination):
+        #runs on a worker thread, the data goes from the response to disk chunk by chunk
+        path = self.account.attachment_cache.fetch(session, self.message_id, attachment, self.account.scheduler)
+        if destination is not None:
+            shutil.copyfile(path, destination)
+            return destination
+        return path
+
+    def on_attachment_opened(self, path):
+        if self:
+            self.attachment_status.SetLabel("")
+            wx.LaunchDefaultApplication(path)
+
+    def on_attachment_saved(self, path):
+        if self:
+            self.attachment_status.SetLabel(f"Saved to {path}")
+
+    def on_attachment_error(self, error):
+        if self:
+            self.attachment_status.SetLabel("")
+            wx.MessageBox(f"Error downloading the attachment: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
+
+#model behind the inbox list: the (account, message id) key of every row in display order,
+#plus headers for the rows that have been looked at recently
+class InboxModel:
+    #number of rows whose headers are kept in memory
+    MAX_CACHED_HEADERS = 5000
+    #column showing which account a row belongs to, only there with more than one account
+    ACCOUNT_COLUMN = 3
+    #shown for rows gmail could not return, so they are not asked for again on every repaint
+    FAILED_ROW = ("(could not be loaded)", "", "")
+
+    def __init__(self):
+        self.keys = []
+        self.headers = OrderedDict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, index):
+        return self.keys[index] if 0 <= index < len(self.keys) else None
+
+    def text(self, index, column):
+        #header text of a row, None when it still has to be loaded
+        key = self.keys[index]
+        if column == self.ACCOUNT_COLUMN:
+            return key[0]
+        row = self.headers.get(key)
+        if row is None:
+            return None
+        self.headers.move_to_end(key)
+        return row[column]
+
+    def set_keys(self, keys):
+        self.keys = list(keys)
+
+    def set_headers(self, rows):
+        #(key, subject, sender, date) rows, the least recently shown ones are dropped first
+        for key, subject, sender, date in rows:
+            self.headers[key] = (subject, sender, date)
+            self.headers.move_to_end(key)
+        while len(self.headers) > self.MAX_CACHED_HEADERS:
+            self.headers.popitem(last=False)
+
+    def forget_headers(self, keys):
+        #the rows are loaded again the next time they are shown
+        for key in keys:
+            self.headers.pop(key, None)
+
+    def insert_rows(self, rows):
+        #put new rows, given newest first, on top
+        self.keys[:0] = [row[0] for row in rows]
+        self.set_headers(rows)
+
+    def remove_keys(self, keys):
+        removed = set(keys)
+        self.keys = [key for key in self.keys if key not in removed]
+        for key in removed:
+            self.headers.pop(key, None)
+
+    def account_ids(self, user_email):
+        #message ids of one account, in display order
+        return [message_id for email, message_id in self.keys if email == user_email]
+
+#virtual list control, only the rows on screen are ever turned into text
+class VirtualEmailList(wx.ListCtrl):
+    def __init__(self, parent, model, on_missing):
+        super(VirtualEmailList, self).__init__(parent, style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.BORDER_THEME)
+        self.model = model
+        #called with the row index when a visible row has no headers yet
+        self.on_missing = on_missing
+
+    def OnGetItemText(self, item, column):
+        text = self.model.text(item, column)
+        if column == 0:
+            metrics.cache('inbox_rows', text is not None)
+        if text is None:
+            self.on_missing(item)
+            return "Loading..." if column == 0 else ""
+        return text
+
+    def refresh_rows(self):
+        with metrics.timed('inbox.populate', rows=len(self.model)):
+            self.SetItemCount(len(self.model))
+            self.Refresh()
+        metrics.gauge('inbox_messages', len(self.model))
+
+#viewing the inbox emails of every signed in account, refreshing emails, option to send emails
 class InboxWindow(wx.Frame):
-    def __init__(self, parent, title, size, service, user_email, flow):
+    #how often the refresh schedule is checked for an account that is due, in milliseconds
+    REFRESH_TICK = 5000
+
+    def __init__(self, parent, title, size, accounts, worker=None):
         super(InboxWindow, self).__init__(parent, title=title, size=size)
         self.panel = wx.Panel(self)
-        self.service = service
-        self.user_email = user_email
+        #accounts.Account objects by address, in the order they were added
+        #each one has its own session, store, attachment folder, quota and sync state,
+        #the list shows their inboxes merged; a session is None while its token is still being checked
+        self.accounts = {account.email: account for account in accounts}
+        self.worker = worker if worker is not None else default_worker()
+        #the refresh currently running in the background for each account, at most one per account
+        self.sync_tasks = {}
+        #accounts whose cached token is being checked
+        self.connecting = set()
+        #one schedule spreads the refreshes of all accounts, instead of a timer per account
+        self.refresh_schedule = RefreshSchedule()
         
+        #all inbox rows of all accounts, headers are loaded page by page as rows come into view
+        self.model = InboxModel()
+        #row pages whose headers are being loaded
+        self.pending_pages = set()
+        #rows gmail failed to return, shown as failed until the next sync of their account
+        self.failed_keys = set()
+        #error of the last timer driven sync of each account that failed, shown in the status line
+        self.sync_errors = {}
+
+        #words being searched for, the list only shows matching emails while it is set
+        self.search_query = ''
+        self.search_task = None
+
         self.inbox_label = wx.StaticText(self.panel, label="Inbox")
-        self.email_list_ctrl = wx.ListCtrl(self.panel, style=wx.LC_REPORT | wx.BORDER_THEME)
+        self.search_ctrl = wx.SearchCtrl(self.panel, style=wx.TE_PROCESS_ENTER)
+        self.search_ctrl.ShowCancelButton(True)
+        self.search_ctrl.SetDescriptiveText("Search subject, sender and text")
+        self.search_ctrl.Bind(wx.EVT_TEXT, self.on_search)
+        self.search_ctrl.Bind(wx.EVT_SEARCHCTRL_CANCEL_BTN, self.on_search_cancel)
+        self.email_list_ctrl = VirtualEmailList(self.panel, self.model, self.request_headers)
 
         self.email_list_ctrl.InsertColumn(0, "Subject", width=300)
         self.email_list_ctrl.InsertColumn(1, "From", width=300)
@@ -58,179 +265,386 @@ class InboxWindow(wx.Frame):
         self.send_email_button.Bind(wx.EVT_BUTTON, self.on_send_email)
         self.refresh_button = wx.Button(self.panel, label="Refresh")
         self.refresh_button.Bind(wx.EVT_BUTTON, self.on_refresh)
+        self.add_account_button = wx.Button(self.panel, label="Add Account")
+        self.add_account_button.Bind(wx.EVT_BUTTON, self.on_add_account)
+
+        self.status_label = wx.StaticText(self.panel, label="")
+
+        #debug status panel with request counts, timings and cache hit rates, F12 shows and hides it
+        self.debug_text = wx.StaticText(self.panel, label="")
+        self.debug_text.SetFont(wx.Font(wx.FontInfo(8).Family(wx.FONTFAMILY_TELETYPE)))
+        self.debug_text.Show(bool(os.environ.get('MAIL_CLIENT_DEBUG')))
+        debug_id = wx.NewIdRef()
+        self.Bind(wx.EVT_MENU, self.on_toggle_debug, id=debug_id)
+        self.SetAcceleratorTable(wx.AcceleratorTable([(wx.ACCEL_NORMAL, wx.WXK_F12, debug_id)]))
+
+        buttons = wx.BoxSizer(wx.HORIZONTAL)
+        buttons.Add(self.send_email_button, 0, wx.ALL, 5)
+        buttons.Add(self.refresh_button, 0, wx.ALL, 5)
+        buttons.Add(self.add_account_button, 0, wx.ALL, 5)
 
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(self.inbox_label, 0, wx.ALL, 5)
+        sizer.Add(self.search_ctrl, 0, wx.EXPAND | wx.ALL, 5)
         sizer.Add(self.email_list_ctrl, 1, wx.EXPAND | wx.ALL, 5)
-        sizer.Add(self.send_email_button, 0, wx.ALL, 5)
-        sizer.Add(self.refresh_button, 0, wx.ALL, 5)
+        sizer.Add(buttons, 0)
+        sizer.Add(self.status_label, 0, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(self.debug_text, 0, wx.EXPAND | wx.ALL, 5)
 
         self.panel.SetSizer(sizer)
 
-        #load emails into the list
-        self.fetch_emails()
-        self.flow = flow
+        #show the cached emails straight away, each account catches up with the server once it has a session
+        for user_email in self.accounts:
+            self.refresh_schedule.add(user_email)
+        self.update_accounts()
+        self.model.set_keys(merge_ids({user_email: account.store.get_ids()
+                                       for user_email, account in self.accounts.items()}))
+        self.email_list_ctrl.refresh_rows()
 
-        #set up timer for real-time updates
+        #set up timer for real-time updates, it syncs whichever account is due
         self.timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.update_emails, self.timer)
-        self.timer.Start(60000)  #1 minute
-
-        #dictionary to store email data
-        self.email_data_dict = {}  
+        self.timer.Start(self.REFRESH_TICK)
+        #refreshes the debug panel and the metrics dump file
+        self.metrics_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.update_metrics, self.metrics_timer)
+        self.metrics_timer.Start(2000)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
+    def on_close(self, event):
+        #stop refreshing and drop results that would arrive after the window is gone
+        self.timer.Stop()
+        self.metrics_timer.Stop()
+        self.worker.cancel_all(owner=self)
+        event.Skip()
+
+    def on_toggle_debug(self, event):
+        self.debug_text.Show(not self.debug_text.IsShown())
+        self.update_metrics(None)
+        self.panel.Layout()
+
+    def update_metrics(self, event):
+        if self.debug_text.IsShown():
+            self.debug_text.SetLabel(metrics.status_text())
+            self.panel.Layout()
+        path = dump_file()
+        if path:
+            try:
+                metrics.dump(path)
+            except OSError:
+                pass
+
+    def update_accounts(self):
+        #label, account column and search box for the current set of accounts
+        metrics.gauge('accounts', len(self.accounts))
+        if len(self.accounts) > 1:
+            self.inbox_label.SetLabel(f"Inbox ({len(self.accounts)} accounts)")
+            if self.email_list_ctrl.GetColumnCount() <= InboxModel.ACCOUNT_COLUMN:
+                self.email_list_ctrl.InsertColumn(InboxModel.ACCOUNT_COLUMN, "Account", width=200)
+        else:
+            self.inbox_label.SetLabel("Inbox")
+        self.search_ctrl.Enable(any(account.store.searchable for account in self.accounts.values()))
 
     def on_refresh(self, event):
-        self.fetch_emails()
-
-    def fetch_emails(self):
-        try:
-            #clear existing items in the list control
-            self.email_list_ctrl.DeleteAllItems()
-            #clear the dictionary
-            self.email_data_dict = {}
-
-            results = self.service.users().messages().list(userId='me', labelIds=['INBOX']).execute()
-            messages = results.get('messages', [])
-
-            for idx, msg in enumerate(messages):
-                message = self.service.users().messages().get(userId='me', id=msg['id']).execute()
-                payload = message['payload']
-                headers = payload['headers']
-
-                subject = next((header['value'] for header in headers if header['name'] == 'Subject'), 'No Subject')
-                sender = next((header['value'] for header in headers if header['name'] == 'From'), 'Unknown Sender')
-                date = next((header['value'] for header in headers if header['name'] == 'Date'), 'No Date')
-
-                index = self.email_list_ctrl.InsertItem(self.email_list_ctrl.GetItemCount(), subject)
-                self.email_list_ctrl.SetItem(index, 1, sender)
-                self.email_list_ctrl.SetItem(index, 2, date)
-
-                # store the email ID in the dictionary with the index as the key
-                self.email_data_dict[index] = msg['id']
-
-        except Exception as e:
-            wx.MessageBox(f"Error fetching emails: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        for account in self.accounts.values():
+            self.sync_emails(account, manual=True)
+
+    def on_add_account(self, event):
+        run_login(self)
+
+    def add_account(self, user_email, token_file, session):
+        #an account signed in from this window, new accounts join the merged list
+        account = self.accounts.get(user_email)
+        if account is None:
+            account = Account(user_email, token_file, pool=default_pool())
+            self.accounts[user_email] = account
+            self.refresh_schedule.add(user_email)
+            self.update_accounts()
+            self.run_search()
+        self.set_session(account, session)
+
+    def connect_account(self, account):
+        #check and refresh the cached token of the account in the background
+        if account.email in self.connecting:
+            return
+        self.connecting.add(account.email)
+        self.refresh_schedule.start(account.email)
+        self.worker.submit(account.open_session,
+                           on_success=lambda session: self.on_account_connected(account, session),
+                           on_error=lambda error: self.on_connect_error(account, error), owner=self)
+
+    def on_connect_error(self, account, error):
+        from google.auth.exceptions import RefreshError
+
+        self.connecting.discard(account.email)
+        if isinstance(error, RefreshError):
+            #the grant was revoked or is invalid, only signing in again helps
+            run_login(self, account.email)
+        else:
+            #offline or google unreachable, the account keeps showing its store and the schedule tries again
+            self.refresh_schedule.synced(account.email, changed=False)
+
+    def on_account_connected(self, account, session):
+        self.connecting.discard(account.email)
+        if session is None:
+            #the cached token can no longer be refreshed, sign in again
+            run_login(self, account.email)
+        else:
+            self.set_session(account, session)
+
+    def set_session(self, account, session):
+        #the Gmail session is ready, load what the store is missing and catch up with the server
+        account.session = session
+        self.pending_pages.clear()
+        self.email_list_ctrl.refresh_rows()
+        self.sync_emails(account)
+
+    def require_session(self, account):
+        if account.session is None:
+            wx.MessageBox(f"Still connecting to Gmail for {account.email}, please try again in a moment.",
+                          "Info", wx.OK | wx.ICON_INFORMATION)
+            return False
+        return True
+
+    def choose_account(self, message):
+        #the account to act for, asked only when there is more than one
+        if len(self.accounts) == 1:
+            return next(iter(self.accounts.values()))
+        with wx.SingleChoiceDialog(self, message, "Account", list(self.accounts)) as dialog:
+            if dialog.ShowModal() != wx.ID_OK:
+                return None
+            return self.accounts[dialog.GetStringSelection()]
+
+    def request_headers(self, index):
+        #load headers for the page of rows around index, from the stores or else from gmail
+        page = index // BATCH_SIZE
+        if page in self.pending_pages:
+            return
+        self.pending_pages.add(page)
+        keys = self.model.keys[page * BATCH_SIZE:(page + 1) * BATCH_SIZE]
+        self.worker.submit(self.fetch_headers, keys,
+                           on_success=lambda result: self.on_headers_loaded(page, result),
+                           on_error=lambda error: self.pending_pages.discard(page), owner=self)
+
+    def fetch_headers(self, keys):
+        #runs on a worker thread, returns the rows, the keys gmail failed to return
+        #and whether every account of the page was online
+        #accounts without a session only read their store, a page can hold rows of several accounts
+        message_ids = {}
+        for user_email, message_id in keys:
+            message_ids.setdefault(user_email, []).append(message_id)
+        rows = []
+        failed_keys = []
+        complete = True
+        with metrics.timed('inbox.load_headers', rows=len(keys)):
+            for user_email, account_ids in message_ids.items():
+                account = self.accounts.get(user_email)
+                if account is None:
+                    continue
+                service = account.service
+                complete = complete and service is not None
+                account_rows, failed_ids = load_headers(service, account.store, account_ids, account.scheduler)
+                rows.extend(((user_email, row[0]),) + row[1:] for row in account_rows)
+                failed_keys.extend((user_email, message_id) for message_id in failed_ids)
+        return rows, failed_keys, complete
+
+    def on_headers_loaded(self, page, result):
+        #while an account has no session the page stays pending, set_session asks for it again
+        rows, failed_keys, complete = result
+        if complete:
+            self.pending_pages.discard(page)
+        self.model.set_headers(rows)
+        #a placeholder keeps the repaint from asking for the same ids again until the next sync
+        self.failed_keys.update(failed_keys)
+        self.model.set_headers([(key,) + InboxModel.FAILED_ROW for key in failed_keys])
+        self.email_list_ctrl.refresh_rows()
+
+    def fetch_emails(self, account):
+        #full sync, runs on a worker thread
+        #only ids are listed here, headers come later as rows are shown
+        with metrics.timed('inbox.full_sync', account=account.email):
+            return full_sync(account.service, account.store, on_page=lambda page_ids: check_cancelled(),
+                             scheduler=account.scheduler)
+
+    def fetch_changes(self, account, history_id):
+        #incremental sync, runs on a worker thread
+        with metrics.timed('inbox.incremental_sync', account=account.email):
+            return incremental_sync(account.service, account.store, history_id,
+                                    on_page=lambda page_ids: check_cancelled(), scheduler=account.scheduler)
+
+    def sync_emails(self, account, manual=False):
+        #apply only the changes since the last sync, fall back to a full fetch when needed
+        #only a sync the user asked for with Refresh reports its error in a dialog
+        sync_task = self.sync_tasks.get(account.email)
+        if sync_task is not None and not sync_task.done():
+            #a refresh of this account is already in flight
+            return
+        if account.session is None:
+            #still offline, try the token again, set_session starts the first sync once it works
+            self.connect_account(account)
+            return
+
+        self.refresh_schedule.start(account.email)
+        if account.history_id is None:
+            sync_task = self.worker.submit(
+                self.fetch_emails, account, on_success=lambda result: self.on_sync_done(account, result),
+                on_error=lambda error: self.on_sync_error(account, error, manual), owner=self)
+        else:
+            sync_task = self.worker.submit(
+                self.fetch_changes, account, account.history_id,
+                on_success=lambda result: self.on_sync_done(account, result),
+                on_error=lambda error: self.on_sync_error(account, error, manual), owner=self)
+        self.sync_tasks[account.email] = sync_task
+
+    def on_sync_done(self, account, result):
+        account.history_id = result['history_id']
+        changed = result['full'] or bool(result['rows'] or result['removed_ids'])
+        self.refresh_schedule.synced(account.email, changed)
+        if self.sync_errors.pop(account.email, None) is not None:
+            self.show_sync_errors()
+        #rows that failed to load are tried once more after every sync
+        retry_keys = [key for key in self.failed_keys if key[0] == account.email]
+        self.failed_keys.difference_update(retry_keys)
+        self.model.forget_headers(retry_keys)
+        if self.search_query:
+            #the store is up to date, show what now matches the search
+            if changed:
+                self.run_search()
+            return
+        if result['full']:
+            #the new list of this account is merged with the lists of the others
+            self.model.set_keys(merge_ids({user_email: result['ids'] if user_email == account.email
+                                           else self.model.account_ids(user_email) for user_email in self.accounts}))
+        else:
+            self.model.remove_keys([(account.email, message_id) for message_id in result['removed_ids']])
+            self.model.insert_rows([((account.email, row[0]),) + row[1:] for row in result['rows']])
+        #row positions moved, headers of the visible pages are requested again where missing
+        self.pending_pages.clear()
+        self.email_list_ctrl.refresh_rows()
+
+    def on_sync_error(self, account, error, manual=False):
+        self.refresh_schedule.synced(account.email, changed=False)
+        if manual:
+            wx.MessageBox(f"Error fetching emails for {account.email}: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
+            return
+        #a timer driven sync fails quietly, e.g. while offline, and is tried again by the schedule
+        log_event(logging.WARNING, 'sync_error', account=account.email, error=repr(error))
+        self.sync_errors[account.email] = str(error)
+        self.show_sync_errors()
+
+    def show_sync_errors(self):
+        self.status_label.SetLabel("; ".join(f"Could not refresh {user_email}: {error}"
+                                             for user_email, error in self.sync_errors.items()))
+        self.panel.Layout()
+
+    def on_search(self, event):
+        self.search_query = self.search_ctrl.GetValue().strip()
+        self.run_search()
+
+    def on_search_cancel(self, event):
+        self.search_ctrl.SetValue('')
+
+    def run_search(self):
+        #filter the list with the local indexes, the network is never touched
+        if self.search_task is not None:
+            self.search_task.cancel()
+        self.search_task = self.worker.submit(self.search_accounts, list(self.accounts.values()), self.search_query,
+                                              on_success=self.show_keys, on_error=self.on_search_error, owner=self)
+
+    def search_accounts(self, accounts, query):
+        #runs on a worker thread, matches of every account merged newest first, the whole inbox without query
+        return merge_ids({account.email: account.store.search(query) if query else account.store.get_ids()
+                          for account in accounts})
+
+    def show_keys(self, keys):
+        self.model.set_keys(keys)
+        self.pending_pages.clear()
+        self.email_list_ctrl.refresh_rows()
+
+    def on_search_error(self, error):
+        wx.MessageBox(f"Error searching emails: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
 
     def on_email_selected(self, event):
         #get the selected item index
         selected_index = event.GetIndex()
-        #get the email ID using the index from the dictionary
-        email_id = self.email_data_dict.get(selected_index, '')
-        #fetch the full content of the selected email
-        try:
-            if email_id:
-                selected_email = self.service.users().messages().get(userId='me', id=email_id).execute()
-                email_body = self.get_email_body(selected_email['payload'])
-                EmailViewer(None, title='Email Viewer', email_content=email_body)
-
-        except Exception as e:
-            wx.MessageBox(f"Error fetching email content: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        #get the account and email ID of the row from the list model
+        key = self.model.key(selected_index)
+        if key is None or key[0] not in self.accounts:
+            return
+        account = self.accounts[key[0]]
+        email_id = key[1]
+
+        #serve the body from the local cache, fetch the full content in the background on a miss
+        email_body = account.store.get_body(email_id)
+        attachments = account.store.get_attachments(email_id)
+        if email_body is not None and attachments is not None:
+            metrics.cache('store_bodies', True)
+            self.show_email((account, email_id, email_body, attachments))
+        elif self.require_session(account):
+            self.worker.submit(self.fetch_email_body, account, email_id,
+                               on_success=self.show_email, on_error=self.on_email_error, owner=self)
+
+    def fetch_email_body(self, account, email_id):
+        #runs on a worker thread, attachments are listed but not downloaded
+        with metrics.timed('inbox.open_email'):
+            email_body, attachments = load_message(account.service, account.store, email_id, account.scheduler)
+        return account, email_id, email_body, attachments
+
+    def show_email(self, email):
+        account, email_id, email_body, attachments = email
+        EmailViewer(None, title='Email Viewer', email_content=email_body, message_id=email_id,
+                    attachments=attachments, account=account, worker=self.worker)
+
+    def on_email_error(self, error):
+        wx.MessageBox(f"Error fetching email content: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
 
-        self.fetch_emails()
-        
     def update_emails(self, event):
-        # update emails periodically
-        self.fetch_emails()
+        # update emails periodically, only downloading what changed, one account at a time
+        user_email = self.refresh_schedule.due_account()
+        if user_email is not None:
+            self.sync_emails(self.accounts[user_email])
 
     def on_send_email(self, event):
+        account = self.choose_account("Send from")
+        if account is None or not self.require_session(account):
+            return
         try:
-            # fetch credentials directly from the flow object
-            credentials = self.flow.credentials
-            # open the MailClient window for composing an email
-            MailClient(None, title='Mail Client', size=(600, 600), credentials=credentials, user_email=self.user_email)
+            # open the MailClient window for composing an email, it shares the account's Gmail session
+            MailClient(None, title='Mail Client', size=(600, 600), session=account.session, user_email=account.email,
+                       worker=self.worker, scheduler=account.scheduler)
 
         except Exception as e:
             wx.MessageBox(f"Error opening MailClient: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
 
-    def get_email_body(self, payload):
-        #extract and decode the email body from the payload
-        parts = payload.get('parts', [])
-        for part in parts:
-            if 'body' in part and 'data' in part['body']:
-                data = part['body']['data']
-                data = data.replace("-", "+").replace("_", "/")
-                decoded_data = base64.b64decode(data)
-                soup = BeautifulSoup(decoded_data, "lxml")
-                return soup.body.text
-        return 'No Content'
-
-    def getEmails(self):
-        try:
-            #load credentials from the json file
-            creds = None
-            credentials_file = 'credentials.json'
-
-            if os.path.exists(credentials_file):
-                with open(credentials_file, 'r') as creds_file:
-                    creds_data = creds_file.read()
-                    if creds_data:
-                        creds_info = json.loads(creds_data)
-                        creds = Credentials.from_authorized_user_info(creds_info)
-
-            # if credentials are not available or are invalid, ask the user to log in.
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    flow = InstalledAppFlow.from_client_secrets_file('credentials.json')
-                    creds = flow.run_local_server(port=0)
-
-                # save the access token in the json file for the next run
-                with open(credentials_file, 'w') as creds_file:
-                    creds_file.write(creds.to_json())
-
-            # connect to the Gmail API
-            service = build('gmail', 'v1', credentials=creds)
-            # request a list of all the messages
-            result = service.users().messages().list(userId='me').execute()
-            # messages is a list of dictionaries where each dictionary contains a message id.
-            messages = result.get('messages')
-
-            for msg in messages:
-                #get the message from its id
-                txt = service.users().messages().get(userId='me', id=msg['id']).execute()
-                #use try-except to avoid any Errors
-                try:
-                    #get value of 'payload' from dictionary 'txt'
-                    payload = txt['payload']
-                    headers = payload['headers']
-
-                    #look for Subject and Sender Email in the headers
-                    subject = next((d['value'] for d in headers if d['name'] == 'Subject'), 'No Subject')
-                    sender = next((d['value'] for d in headers if d['name'] == 'From'), 'Unknown Sender')
-
-                    #the body of the message is in Encrypted format
-                    #get the data and decode it with base 64 decoder
-                    parts = payload.get('parts')[0]
-                    data = parts['body']['data']
-                    data = data.replace("-", "+").replace("_", "/")
-                    decoded_data = base64.b64decode(data)
-
-                    #Now, the data obtained is in lxml. So, we will parse it with BeautifulSoup library
-                    soup = BeautifulSoup(decoded_data, "lxml")
-                    body = soup.body() # Extract text content from the body
-
-                    #printing the subject, sender's email, and message
-                    print("Subject:", subject)
-                    print("From:", sender)
-                    print("Message:", body)
-                    print('\n')
-
-                except Exception as e:
-                    wx.MessageBox(f"Error processing email: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+    def getEmails(self, output='mail_export.mbox', output_format='mbox', user_email=None):
+        #export the whole mailbox of an account in the background, bulk_export.py does the same from the command line
+        account = self.accounts[user_email] if user_email else next(iter(self.accounts.values()))
+        if not self.require_session(account):
+            return
+        self.worker.submit(export_mailbox, account.session, output, output_format, scheduler=account.scheduler,
+                           on_success=self.on_export_done, on_error=self.on_export_error, owner=self)
 
-        except Exception as e:
-            wx.MessageBox(f"Error fetching emails: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+    def on_export_done(self, counts):
+        wx.MessageBox(f"Exported {counts['exported']} emails, {counts['skipped']} already exported, "
+                      f"{counts['failed']} failed", "Export", wx.OK | wx.ICON_INFORMATION)
+
+    def on_export_error(self, error):
+        wx.MessageBox(f"Error exporting emails: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
 
 class LoginDialog(wx.Dialog):
-    def __init__(self, parent, title):
+    #seconds the browser sign-in may take, after that the local redirect server gives up
+    #and the worker thread waiting on it is free again
+    BROWSER_TIMEOUT = 300
+
+    def __init__(self, parent, title, user_email=''):
         super(LoginDialog, self).__init__(parent, title=title, size=(250, 300))
 
         panel = wx.Panel(self)
         sizer = wx.BoxSizer(wx.VERTICAL)
 
         self.email_label = wx.StaticText(panel, label="Email:")
-        self.email_text = wx.TextCtrl(panel)
+        #filled in when an account that signed in before has to sign in again
+        self.email_text = wx.TextCtrl(panel, value=user_email)
 
         self.password_label = wx.StaticText(panel, label="Password:")
         self.password_text = wx.TextCtrl(panel, style=wx.TE_PASSWORD)
@@ -260,77 +674,100 @@ class LoginDialog(wx.Dialog):
         panel.SetSizer(sizer)
         self.Centre()
         self.flow = None
+        #address, token file and Gmail session of the account that signed in
+        self.user_email = None
+        self.token_file = None
+        self.session = None
+        #the sign-in running in the background, cancelled when the dialog is closed
+        self.login_task = None
+        self.Bind(wx.EVT_CLOSE, self.on_cancel)
+        self.Bind(wx.EVT_BUTTON, self.on_cancel, id=wx.ID_CANCEL)
+
+    def on_cancel(self, event):
+        #a sign-in that finishes after this is dropped
+        if self.login_task is not None:
+            self.login_task.cancel()
+        event.Skip()
 
     def on_login(self, event):
         email = self.email_text.GetValue()
         password = self.password_text.GetValue()
 
-        #check if token file exists
-        token_file = 'token.json'
-        if os.path.exists(token_file):
-            try:
-                #load stored credentials from file
-                with open(token_file, 'r') as token:
-                    credentials_data = token.read()
-                    if not credentials_data:
-                        raise ValueError("Empty credentials file")
-                    self.credentials = Credentials.from_authorized_user_info(json.loads(credentials_data), ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.compose', 'https://www.googleapis.com/auth/gmail.send'])   
-                # set up the Gmail API service
-                self.service = build('gmail', 'v1', credentials=self.credentials)
-                # close the login dialog
-                self.EndModal(wx.ID_OK)
-                return
+        #loading the token, the browser flow and building the service talk to google, keep them off the ui thread
+        self.login_button.Disable()
+        self.login_task = default_worker().submit(self.login, email, password, on_success=self.on_login_done,
+                                                  on_error=self.on_login_error, owner=self)
 
-            except ValueError as ve:
-                wx.MessageBox(f"Error loading stored credentials: {str(ve)}", "Error", wx.OK | wx.ICON_ERROR)
-            except Exception as e:
-                wx.MessageBox(f"Error loading stored credentials: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+    def login(self, email, password):
+        #runs on a worker thread, returns the address, token file and Gmail session of the account
+        #a cached token of a known account is checked and refreshed if needed without the browser
+        session = None
+        token_file = dict(load_accounts()).get(email)
+        if token_file is not None:
+            from google.auth.exceptions import RefreshError
 
-        # if the token file is empty or not present, authenticate and get Gmail service
-        self.flow = self.authenticate(email, password)
-        
-        if self.flow:
-            # save the credentials for future use
-            with open(token_file, 'w') as token:
-                token.write(self.flow.credentials.to_json())
-            # set up the Gmail API service
-            self.service = build('gmail', 'v1', credentials=self.flow.credentials)
-            # close the login dialog
-            self.EndModal(wx.ID_OK)
-
-    def authenticate(self, email, password):
-        try:
-            #set up OAuth 2.0 credentials
-            self.flow = InstalledAppFlow.from_client_secrets_file(
-                'path\\to\\credentials.json',                
-                scopes=['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.compose', 'https://www.googleapis.com/auth/gmail.send'])
-            
-            credentials = self.flow.run_local_server(port=0)
-
-            if not credentials:
-                raise ValueError("Authentication failed or credentials are None")
-            
-            # build the Gmail API service
-            service = build('gmail', 'v1', credentials=credentials)
-            return service
-
-        except ValueError as ve:
-            wx.MessageBox(f"Authentication error: {str(ve)}", "Error", wx.OK | wx.ICON_ERROR)
-            return None
-        except Exception as e:
-            wx.MessageBox(f"Authentication error: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
-            return None
+            try:
+                session = open_session(token_file, default_pool())
+            except RefreshError as e:
+                #only a token that can no longer be refreshed calls for the browser, network errors are reported
+                wx.CallAfter(wx.MessageBox, f"Error loading stored credentials: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+
+        if session is None:
+            # if the token file is empty, expired for good or not present, authenticate and get Gmail service
+            with metrics.timed('login.browser'):
+                session = self.run_auth_flow()
+            #the address gmail reports is the one the token belongs to, whatever was typed
+            email = get_email_address(session.service)
+            # save the credentials for future use, the next start opens this account without the dialog
+            token_file = register_account(email)
+            save_token(self.flow.credentials, token_file)
+        return email, token_file, session
+
+    def on_login_done(self, result):
+        #the dialog may have been closed while the browser sign-in was running
+        if not self:
+            return
+        self.user_email, self.token_file, self.session = result
+        # close the login dialog
+        self.EndModal(wx.ID_OK)
+
+    def on_login_error(self, error):
+        if not self:
+            return
+        self.login_button.Enable()
+        wx.MessageBox(f"Authentication error: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
+
+    def run_auth_flow(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow  #implementing the OAuth 2.0 aouthorization flow
+
+        #set up OAuth 2.0 credentials
+        self.flow = InstalledAppFlow.from_client_secrets_file(
+            'path\\to\\credentials.json',
+            scopes=SCOPES)
+
+        #without a timeout a closed browser tab would keep the worker thread, and the process, waiting forever
+        credentials = self.flow.run_local_server(port=0, timeout_seconds=self.BROWSER_TIMEOUT)
+
+        if not credentials:
+            raise ValueError("Authentication failed or credentials are None")
+
+        # set up the Gmail session, over the connections every account shares
+        return GmailSession(credentials, pool=default_pool())
 
     def create_account(self, event):
         # open the default web browser to Gmail account creation page
+        import webbrowser
         webbrowser.open("https://accounts.google.com/signup")
 
 class MailClient(wx.Frame):
-    def __init__(self, parent, title, size, credentials, user_email):
+    def __init__(self, parent, title, size, session, user_email, worker=None, scheduler=None):
         super(MailClient, self).__init__(parent, title=title, size=size)
         self.panel = wx.Panel(self)
-        self.credentials = credentials
+        self.session = session
         self.user_email = user_email
+        self.worker = worker if worker is not None else default_worker()
+        #quota of the account the email is sent from
+        self.scheduler = scheduler if scheduler is not None else default_scheduler()
 
         self.to_label = wx.StaticText(self.panel, label="To:")
         self.to_text = wx.TextCtrl(self.panel)
@@ -347,6 +784,15 @@ class MailClient(wx.Frame):
         self.send_button = wx.Button(self.panel, label="Send", size=(70, 30))
         self.send_button.Bind(wx.EVT_BUTTON, self.on_send)
 
+        #the subject and body are templates, {column} is replaced with each recipient's value
+        self.merge_button = wx.Button(self.panel, label="Mail Merge...", size=(120, 30))
+        self.merge_button.Bind(wx.EVT_BUTTON, self.on_mail_merge)
+        self.stop_merge_button = wx.Button(self.panel, label="Stop Merge", size=(120, 30))
+        self.stop_merge_button.Bind(wx.EVT_BUTTON, self.on_stop_merge)
+        self.stop_merge_button.Disable()
+        #the campaign running in the background, None when there is none
+        self.merge_task = None
+
         self.inbox_button = wx.Button(self.panel, label="Inbox", size=(70, 30))
         self.inbox_button.Bind(wx.EVT_BUTTON, self.open_inbox)
 
@@ -361,15 +807,23 @@ class MailClient(wx.Frame):
         sizer.Add(self.body_text, 1, wx.EXPAND | wx.ALL, 5)
         sizer.Add(self.attach_button, 0, wx.ALL, 5)
         sizer.Add(self.send_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
+        sizer.Add(self.merge_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
+        sizer.Add(self.stop_merge_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
         sizer.Add(self.inbox_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
         sizer.Add(self.status_text, 1, wx.EXPAND|wx.ALL, 5)
 
         self.panel.SetSizer(sizer)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
         self.Show()
 
         #list to store attached files
         self.attachments = []
 
+    def on_close(self, event):
+        #a campaign still running stops with the window, the sends under way are still logged
+        self.worker.cancel_all(owner=self)
+        event.Skip()
+
     def on_attach(self, event):
         with wx.FileDialog(self, "Choose files to attach", wildcard="All files (*.*)|*.*", style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST | wx.FD_MULTIPLE) as fileDialog:
             if fileDialog.ShowModal() == wx.ID_OK:
@@ -384,57 +838,175 @@ class MailClient(wx.Frame):
     
     def on_send(self, event):
         receiver_email = self.to_text.GetValue()
-
-        msg = MIMEMultipart()
-        msg['Subject'] = self.subject_text.GetValue()
-        msg['From'] = self.user_email
-        msg['To'] = receiver_email
-        msg.attach(MIMEText(self.body_text.GetValue(), 'plain'))
-
-        # attach files to the email
-        for attachment in self.attachments:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(open(attachment, 'rb').read())
-            encoders.encode_base64(part)
-            part.add_header('Content-Disposition', f'attachment; filename="{os.path.basename(attachment)}"')
-            msg.attach(part)
-
-        try:
-            # create an instance of the Gmail API service
-            service = build('gmail', 'v1', credentials=self.credentials)
-            
-            # send the email using Gmail API
-            message = {'raw': base64.urlsafe_b64encode(msg.as_bytes()).decode('utf-8')}
-            service.users().messages().send(userId=self.user_email, body=message).execute()
-
-            wx.MessageBox("Email sent successfully!", "Success", wx.OK | wx.ICON_INFORMATION)
-        except HttpError as e:
-            wx.MessageBox(f"An error occurred while sending the email: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
-        except Exception as e:
-            wx.MessageBox(f"An error occurred: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        subject = self.subject_text.GetValue()
+        body = self.body_text.GetValue()
+
+        #reading attachments and uploading happen in the background, the window stays responsive
+        self.send_button.Disable()
+        self.status_text.AppendText("Sending...\n")
+        self.worker.submit(self.send_message, receiver_email, subject, body, list(self.attachments),
+                           on_success=self.on_send_done, on_error=self.on_send_error, owner=self)
+
+    def send_message(self, receiver_email, subject, body, attachments):
+        #runs on a worker thread
+        if is_large_message(attachments):
+            with metrics.timed('send', large=True, attachments=len(attachments)):
+                return self.send_large_message(receiver_email, subject, body, attachments)
+
+        # send the email using Gmail API
+        with metrics.timed('send', large=False, attachments=len(attachments)):
+            message = build_raw_message(self.user_email, receiver_email, subject, body, attachments)
+            request = self.session.service.users().messages().send(userId=self.user_email, body=message)
+            self.scheduler.execute(request, idempotent=False)
+
+    def send_large_message(self, receiver_email, subject, body, attachments):
+        #runs on a worker thread
+        #the email is written to a temporary file chunk by chunk and uploaded from there,
+        #so memory use does not grow with the size of the attachments
+        with tempfile.TemporaryFile() as message_file:
+            write_message(message_file, self.user_email, receiver_email, subject, body, attachments)
+            message_file.seek(0)
+            send_message_stream(self.session.service, message_file, progress=lambda done: wx.CallAfter(self.show_progress, done),
+                                scheduler=self.scheduler)
+
+    def show_progress(self, done):
+        if self:
+            self.status_text.AppendText(f"Uploaded {done:.0%}\n")
+
+    def on_send_done(self, result):
+        #the window may have been closed while the email was being sent
+        if self:
+            self.send_button.Enable()
+        wx.MessageBox("Email sent successfully!", "Success", wx.OK | wx.ICON_INFORMATION)
+
+    def on_send_error(self, error):
+        if self:
+            self.send_button.Enable()
+        if isinstance(error, HttpError):
+            wx.MessageBox(f"An error occurred while sending the email: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
+        else:
+            wx.MessageBox(f"An error occurred: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
+
+    def on_mail_merge(self, event):
+        #send the email to every recipient of a csv file, in the background
+        with wx.FileDialog(self, "Choose the recipient list", wildcard="CSV files (*.csv)|*.csv|All files (*.*)|*.*",
+                           style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
+            if fileDialog.ShowModal() != wx.ID_OK:
+                return
+            recipients_path = fileDialog.GetPath()
+
+        self.send_button.Disable()
+        self.merge_button.Disable()
+        self.stop_merge_button.Enable()
+        self.status_text.AppendText("Starting mail merge...\n")
+        self.merge_task = self.worker.submit(
+            self.run_mail_merge, recipients_path, self.subject_text.GetValue(), self.body_text.GetValue(),
+            list(self.attachments), on_success=lambda counts: self.on_merge_done(counts, merge_log_path(recipients_path)),
+            on_error=self.on_merge_error, owner=self)
+
+    def on_stop_merge(self, event):
+        #sends not started are dropped, the ones under way finish and are logged before the buttons come back
+        if self.merge_task is None:
+            return
+        self.stop_merge_button.Disable()
+        self.status_text.AppendText("Stopping mail merge...\n")
+        self.merge_task.cancel()
+        self.merge_task.future.add_done_callback(lambda future: wx.CallAfter(self.on_merge_stopped))
+
+    def on_merge_stopped(self):
+        if not self:
+            return
+        self.merge_task = None
+        self.send_button.Enable()
+        self.merge_button.Enable()
+        self.status_text.AppendText("Mail merge stopped, running it again continues with the recipients not sent yet.\n")
+
+    def run_mail_merge(self, recipients_path, subject, body, attachments):
+        #runs on a worker thread, the attachments are encoded once for all recipients
+        recipients = read_recipients(recipients_path)
+
+        def progress(counts):
+            #raising Cancelled here stops the campaign once Stop Merge is pressed or the window closes
+            check_cancelled()
+            wx.CallAfter(self.show_merge_progress, counts, len(recipients))
+
+        with metrics.timed('merge', recipients=len(recipients), attachments=len(attachments)):
+            return send_campaign(self.session, self.user_email, recipients, subject, body,
+                                 merge_log_path(recipients_path), attachments, scheduler=self.scheduler,
+                                 progress=progress)
+
+    def show_merge_progress(self, counts, total):
+        if self:
+            self.status_text.AppendText(f"Sent {counts['sent']} of {total}, {counts['skipped']} skipped, "
+                                        f"{counts['failed']} failed\n")
+
+    def on_merge_done(self, counts, log_path):
+        if self:
+            self.merge_task = None
+            self.send_button.Enable()
+            self.merge_button.Enable()
+            self.stop_merge_button.Disable()
+        wx.MessageBox(f"Mail merge finished: {counts['sent']} sent, {counts['skipped']} already sent, "
+                      f"{counts['failed']} failed.\nThe result of every recipient is in {log_path}, "
+                      f"running the merge again retries the failed ones.", "Mail Merge", wx.OK | wx.ICON_INFORMATION)
+
+    def on_merge_error(self, error):
+        if self:
+            self.merge_task = None
+            self.send_button.Enable()
+            self.merge_button.Enable()
+            self.stop_merge_button.Disable()
+        wx.MessageBox(f"Mail merge stopped: {str(error)}", "Error", wx.OK | wx.ICON_ERROR)
 
     def open_inbox(self, event):
         # close the current MailClient window
         self.Close()
 
-if __name__ == '__main__':
-    app = wx.App()
+def show_inbox(accounts):
+    # create and show InboxWindow, the sessions of the accounts may still be None
+    inbox_window = InboxWindow(None, title='Inbox', size=(900, 700), accounts=accounts)
+    inbox_window.Bind(wx.EVT_LIST_ITEM_ACTIVATED, inbox_window.on_email_selected)
+    inbox_window.Show()
+    return inbox_window
 
-    login_dialog = LoginDialog(None, title='Login')
+def run_login(inbox_window=None, user_email=''):
+    #show the login dialog, the account that signs in is added to inbox_window or gets a new one
+    #user_email is set when a known account has to sign in again
+    login_dialog = LoginDialog(None, title='Login', user_email=user_email)
 
     if login_dialog.ShowModal() == wx.ID_OK:
-        # user clicked "Login" in the dialog
-        sender_email = login_dialog.email_text.GetValue()
-        sender_password = login_dialog.password_text.GetValue()
-        # authenticate and get Gmail service
-        service = login_dialog.authenticate(sender_email, sender_password)
+        # user clicked "Login" in the dialog, which already authenticated and set up the Gmail session
+        if inbox_window:
+            inbox_window.add_account(login_dialog.user_email, login_dialog.token_file, login_dialog.session)
+        else:
+            account = Account(login_dialog.user_email, login_dialog.token_file, pool=default_pool())
+            inbox_window = show_inbox([account])
+            inbox_window.set_session(account, login_dialog.session)
+    elif inbox_window and user_email and len(inbox_window.accounts) == 1:
+        #the only account cannot sign in any more
+        inbox_window.Destroy()
+
+    login_dialog.Destroy()
 
-        if service:
-            # create and show InboxWindow with the service passed as an argument
-            inbox_window = InboxWindow(None, title='Inbox', size=(900, 700), service=service, user_email=sender_email, flow=login_dialog.flow)
-            inbox_window.Bind(wx.EVT_LIST_ITEM_ACTIVATED, inbox_window.on_email_selected)
-            inbox_window.Show()
+if __name__ == '__main__':
+    configure_logging()
+    started = time.perf_counter()
+    app = wx.App()
 
-            login_dialog.Destroy()
+    accounts = [Account(user_email, token_file, pool=default_pool())
+                for user_email, token_file in load_accounts() if os.path.exists(token_file)]
+    if accounts:
+        #every account's inbox opens from its local store straight away,
+        #the tokens are checked and refreshed in the background and the first syncs follow
+        inbox_window = show_inbox(accounts)
+        for account in accounts:
+            inbox_window.connect_account(account)
+    else:
+        run_login()
+    #runs once the main loop is up and the first window is on screen
+    wx.CallAfter(lambda: metrics.gauge('startup_seconds', time.perf_counter() - started))
 
     app.MainLoop()
+    default_worker().shutdown()
+    if dump_file():
+        metrics.dump(dump_file())
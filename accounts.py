@@ -0,0 +1,207 @@
+#several gmail accounts in one client
+#every account has its own token, message store, attachment folder, sync state and request
+#scheduler, since gmail counts quota per user; what does not depend on the account is shared:
+#the worker threads, the keep-alive connections (one gmail_session.ConnectionPool) and a single
+#refresh schedule that spreads the syncs of all accounts over the refresh interval
+#nothing here touches wx, the inbox window keeps the accounts and drives the schedule
+
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+
+from gmail_fetch import get_email_address
+from gmail_session import GmailSession, SCOPES, TOKEN_FILE, load_account, load_token, save_token
+from mail_attachments import AttachmentCache, default_attachment_dir
+from message_store import STORE_DIR, MessageStore, body_budget, default_store_path
+from metrics import metrics
+from rate_limit import RequestScheduler
+
+
+#addresses of the accounts that have signed in, in the order they were added, with their token files
+ACCOUNTS_FILE = os.path.join(STORE_DIR, 'accounts.json')
+#seconds between two syncs of an account where mail keeps arriving
+REFRESH_INTERVAL = 60
+#accounts where nothing changed are synced less and less often, down to once per this many seconds
+MAX_REFRESH_INTERVAL = 300
+
+_accounts_lock = threading.Lock()
+
+
+def token_path(user_email):
+    #the cached OAuth token of an account
+    name = user_email.strip() or 'default'
+    return os.path.join(STORE_DIR, 'tokens', f'{name}.json')
+
+
+def load_accounts(accounts_file=ACCOUNTS_FILE):
+    #[(email, token file)] of every account that signed in before
+    #a client that only knew one account left its address in account.json and its token in token.json,
+    #that account becomes the first one
+    try:
+        with open(accounts_file, 'r') as accounts:
+            return [(entry['email'], entry['token']) for entry in json.load(accounts)]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    user_email = load_account()
+    if user_email is not None and os.path.exists(TOKEN_FILE):
+        return [(user_email, os.path.abspath(TOKEN_FILE))]
+    return []
+
+
+def save_accounts(entries, accounts_file=ACCOUNTS_FILE):
+    os.makedirs(os.path.dirname(os.path.abspath(accounts_file)), exist_ok=True)
+    partial = accounts_file + '.tmp'
+    with open(partial, 'w') as accounts:
+        json.dump([{'email': email, 'token': token_file} for email, token_file in entries], accounts, indent=2)
+    os.replace(partial, accounts_file)
+
+
+def register_account(user_email, accounts_file=ACCOUNTS_FILE):
+    #token file of the account, which is added to the list of accounts if it is new
+    with _accounts_lock:
+        entries = load_accounts(accounts_file)
+        for email, token_file in entries:
+            if email == user_email:
+                break
+        else:
+            token_file = token_path(user_email)
+            entries.append((user_email, token_file))
+        os.makedirs(os.path.dirname(os.path.abspath(token_file)), exist_ok=True)
+        save_accounts(entries, accounts_file)
+        return token_file
+
+
+def open_session(token_file, pool=None, root_url=None):
+    #Gmail session from a cached token over the connections of pool, None when the browser login is needed
+    with metrics.timed('login.token'):
+        credentials = load_token(token_file)
+    if credentials is None:
+        return None
+    return GmailSession(credentials, root_url=root_url, pool=pool)
+
+
+def command_line_session(user_email=None, client_secrets=None):
+    #(address, session) for the command line tools, from the token the mail client saved for
+    #user_email, or for its first account when no address is given
+    #without a usable token the browser login runs if client_secrets are given, and the account
+    #that signs in is added to the client's accounts
+    entries = load_accounts()
+    if user_email is None and entries:
+        user_email = entries[0][0]
+    token_file = dict(entries).get(user_email)
+    credentials = load_token(token_file) if token_file is not None else None
+    if credentials is not None:
+        return user_email, GmailSession(credentials)
+
+    if not client_secrets:
+        sys.exit(f"No usable token for {user_email or 'any account'}, "
+                 f"sign in with the mail client first or pass --client-secrets")
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    credentials = InstalledAppFlow.from_client_secrets_file(client_secrets, scopes=SCOPES).run_local_server(port=0)
+    session = GmailSession(credentials)
+    #the address gmail reports is the one the token belongs to
+    user_email = get_email_address(session.service)
+    save_token(credentials, register_account(user_email))
+    return user_email, session
+
+
+class Account:
+    #everything the client keeps for one signed in address
+    #session is None until the token has been loaded, which happens on a worker thread
+    def __init__(self, user_email, token_file, pool=None, store=None, attachment_cache=None, scheduler=None):
+        self.email = user_email
+        self.token_file = token_file
+        self.pool = pool
+        self.store = store if store is not None else MessageStore(default_store_path(user_email), body_budget())
+        self.attachment_cache = attachment_cache or AttachmentCache(default_attachment_dir(user_email))
+        self.scheduler = scheduler or RequestScheduler()
+        self.session = None
+        #where the last sync left the mailbox history, None until the first full sync
+        self.history_id = self.store.get_state('history_id')
+
+    @property
+    def service(self):
+        #gmail service of the calling thread, None while the account has no session
+        return self.session.service if self.session is not None else None
+
+    def open_session(self, root_url=None):
+        #runs on a worker thread, the caller hands the session to the account on the ui thread
+        return open_session(self.token_file, self.pool, root_url)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        self.store.close()
+
+
+def message_order(message_id):
+    #gmail ids grow with the time a message reached the mailbox, which makes them comparable
+    #across accounts without loading any header
+    try:
+        return int(message_id, 16)
+    except ValueError:
+        return 0
+
+
+def merge_ids(ids_by_account):
+    #one newest first list of (email, message id) keys out of the newest first lists of each account
+    #the order inside each account is kept as it is
+    if len(ids_by_account) == 1:
+        [(user_email, message_ids)] = ids_by_account.items()
+        return [(user_email, message_id) for message_id in message_ids]
+    keyed = ([(user_email, message_id) for message_id in message_ids]
+             for user_email, message_ids in ids_by_account.items())
+    return list(heapq.merge(*keyed, key=lambda key: message_order(key[1]), reverse=True))
+
+
+class RefreshSchedule:
+    #decides when each account is synced next
+    #accounts start spread evenly over the interval, so with N accounts a sync goes out every
+    #interval / N seconds instead of N at once; an account whose last sync found nothing new waits
+    #twice as long the next time, up to max_interval, and is back to interval once mail arrives
+    def __init__(self, interval=REFRESH_INTERVAL, max_interval=MAX_REFRESH_INTERVAL):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.due = {}
+        self.waits = {}
+
+    def add(self, user_email, now=None):
+        #the new account is due now and the waiting ones are spread evenly over the interval after it
+        now = time.monotonic() if now is None else now
+        waiting = sorted((email for email, due in self.due.items() if due != float('inf') and email != user_email),
+                         key=self.due.get)
+        self.waits[user_email] = self.interval
+        self.due[user_email] = now
+        step = self.interval / len(self.due)
+        for position, email in enumerate(waiting, 1):
+            self.due[email] = now + position * step
+
+    def remove(self, user_email):
+        self.due.pop(user_email, None)
+        self.waits.pop(user_email, None)
+
+    def due_account(self, now=None):
+        #the most overdue account, None when none is due yet
+        now = time.monotonic() if now is None else now
+        if not self.due:
+            return None
+        user_email = min(self.due, key=self.due.get)
+        return user_email if self.due[user_email] <= now else None
+
+    def start(self, user_email):
+        #the account is syncing, it is not due again until synced() has been called for it
+        if user_email in self.due:
+            self.due[user_email] = float('inf')
+
+    def synced(self, user_email, changed, now=None):
+        #schedule the next sync of an account once its sync has finished
+        if user_email not in self.due:
+            return
+        now = time.monotonic() if now is None else now
+        wait = self.interval if changed else min(self.max_interval, self.waits[user_email] * 2)
+        self.waits[user_email] = wait
+        self.due[user_email] = now + wait
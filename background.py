@@ -0,0 +1,123 @@
+#runs blocking work (Gmail API calls, disk reads) on a bounded thread pool
+#results and errors are handed back to the wx main thread with wx.CallAfter,
+#so the ui never waits on network I/O
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import wx
+
+from metrics import metrics, log_event
+
+
+#number of worker threads shared by all windows
+MAX_WORKERS = 4
+
+_current = threading.local()
+_default_worker = None
+_default_worker_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    #raised inside a task that was cancelled, the task ends without calling back
+    pass
+
+
+def check_cancelled():
+    #long running tasks call this between steps to stop early once cancelled
+    task = getattr(_current, 'task', None)
+    if task is not None and task.cancelled:
+        raise Cancelled()
+
+
+class Task:
+    def __init__(self, owner):
+        self.owner = owner
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        #callbacks of a cancelled task are never delivered
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+
+class BackgroundWorker:
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mail-worker')
+        self.lock = threading.Lock()
+        self.tasks = set()
+
+    def submit(self, func, *args, on_success=None, on_error=None, owner=None, **kwargs):
+        #run func(*args, **kwargs) on a worker thread
+        #on_success(result) or on_error(exception) is then called on the ui thread
+        task = Task(owner)
+
+        def run():
+            _current.task = task
+            try:
+                check_cancelled()
+                result = func(*args, **kwargs)
+            except Cancelled:
+                return
+            except Exception as e:
+                #errors reach the user as a dialog at most, keep a record of every one
+                name = getattr(func, '__name__', type(func).__name__)
+                metrics.count('task_errors_total', task=name, error=type(e).__name__)
+                log_event(logging.WARNING, 'task_error', task=name, error=repr(e))
+                self._deliver(task, on_error, e)
+            else:
+                self._deliver(task, on_success, result)
+            finally:
+                _current.task = None
+
+        def forget(future):
+            #also runs for a task cancelled before it started, whose run never does
+            with self.lock:
+                self.tasks.discard(task)
+
+        with self.lock:
+            self.tasks.add(task)
+        task.future = self.executor.submit(run)
+        task.future.add_done_callback(forget)
+        return task
+
+    def _deliver(self, task, callback, value):
+        if callback is None or task.cancelled:
+            return
+
+        def call():
+            #the task may have been cancelled while the call was queued
+            if not task.cancelled:
+                callback(value)
+
+        wx.CallAfter(call)
+
+    def cancel_all(self, owner=None):
+        #cancel every pending task, or only those started for the given owner
+        with self.lock:
+            tasks = [task for task in self.tasks if owner is None or task.owner is owner]
+        for task in tasks:
+            task.cancel()
+
+    def shutdown(self):
+        self.cancel_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def default_worker():
+    #worker shared by every window of the application
+    global _default_worker
+    with _default_worker_lock:
+        if _default_worker is None:
+            _default_worker = BackgroundWorker()
+        return _default_worker
@@ -0,0 +1,69 @@
+#micro-benchmark of body extraction: the previous BeautifulSoup path against mail_body.extract_body
+#run with: python benchmarks/bench_body_extraction.py [messages] [paragraphs]
+
+import base64
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from mail_body import extract_body
+from sample_payloads import KINDS, make_corpus
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+
+def legacy_body(payload):
+    #the extraction InboxWindow.get_email_body used before mail_body
+    parts = payload.get('parts', [])
+    for part in parts:
+        if 'body' in part and 'data' in part['body']:
+            data = part['body']['data']
+            data = data.replace("-", "+").replace("_", "/")
+            decoded_data = base64.b64decode(data + '=' * (-len(data) % 4))
+            soup = BeautifulSoup(decoded_data, "lxml")
+            return soup.body.text
+    return 'No Content'
+
+
+def time_per_message(extract, payloads, rounds=3):
+    #median over rounds of the mean time per message, in microseconds
+    results = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for payload in payloads:
+            extract(payload)
+        results.append((time.perf_counter() - start) / len(payloads) * 1e6)
+    return statistics.median(results)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    corpus = make_corpus(count, paragraphs=paragraphs)
+
+    if BeautifulSoup is None:
+        print("bs4/lxml not installed, only the new path is measured")
+
+    #"found" counts the messages where a path returned any text at all
+    print(f"{'kind':<12}{'messages':>10}{'legacy us':>12}{'found':>8}{'new us':>10}{'found':>8}{'speedup':>10}")
+    for kind in KINDS + ('all',):
+        payloads = [payload for payload_kind, payload in corpus if kind in ('all', payload_kind)]
+        new = time_per_message(extract_body, payloads)
+        new_found = sum(extract_body(payload) != 'No Content' for payload in payloads)
+        if BeautifulSoup is not None:
+            legacy = time_per_message(legacy_body, payloads)
+            legacy_found = sum(legacy_body(payload) != 'No Content' for payload in payloads)
+            print(f"{kind:<12}{len(payloads):>10}{legacy:>12.1f}{legacy_found:>8}{new:>10.1f}{new_found:>8}"
+                  f"{legacy / new:>9.1f}x")
+        else:
+            print(f"{kind:<12}{len(payloads):>10}{'-':>12}{'-':>8}{new:>10.1f}{new_found:>8}{'-':>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#end to end benchmarks of the client's Gmail paths against the local fake server, no network needed
+#for every mailbox size it reports requests, wall time, bytes each way and peak RSS for:
+#  inbox_load        first start: full sync plus the headers of the first screen of rows
+#  inbox_restart     second start: ids and first screen of headers from the local store
+#  refresh_quiet     incremental sync with nothing new
+#  refresh_new_mail  incremental sync after 25 new emails arrived
+#  open_message      opening 10 emails not seen before
+#  open_cached       opening the same 10 emails again
+#  open_attachment   downloading the first attachment of one of them, --attachment-size bytes
+#  send_small        raw send with a 100 KB attachment
+#  send_large        streamed resumable send with an attachment of --attachment-mb
+#  accounts_load     first start of --accounts accounts in one process, each with its own store and
+#                    quota, all over one pool of connections; compare with inbox_load times the accounts
+#each scenario runs in its own process so peak RSS belongs to that scenario alone
+#
+#run with: python benchmarks/bench_gmail.py --sizes 1000,10000,100000 --latency 20
+#save a baseline with --json base.json, later runs with --compare base.json exit 1 on a regression
+#--rate-limit 0.05 has the server answer 5% of calls with a 429 to exercise the retry scheduler
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+
+from google.oauth2.credentials import Credentials
+
+from accounts import Account
+from gmail_fetch import BATCH_SIZE
+from gmail_session import GmailSession
+from mail_attachments import AttachmentCache
+from mail_sync import full_sync, incremental_sync, load_headers, load_body, load_message
+from message_store import MessageStore
+from mime_stream import build_raw_message, write_message, send_message_stream
+from rate_limit import default_scheduler
+
+
+#emails opened by the open_* scenarios
+OPENED = 10
+#emails injected before refresh_new_mail
+NEW_MAIL = 25
+#metrics compared against a baseline, lower is better for all of them
+METRICS = ('requests', 'wall_ms', 'bytes_out', 'bytes_in', 'peak_rss_mb')
+#allowed growth in bytes against the baseline, relative and absolute: message ids, dates and
+#boundaries of sent emails do not have the same length on every run
+BYTES_TOLERANCE = 0.01
+BYTES_SLACK = 1024
+
+
+def scenario_inbox_load(session, store, options):
+    full_sync(session.service, store)
+    load_headers(session.service, store, store.get_ids()[:BATCH_SIZE])
+
+
+def scenario_inbox_restart(session, store, options):
+    load_headers(session.service, store, store.get_ids()[:BATCH_SIZE])
+
+
+def scenario_refresh(session, store, options):
+    incremental_sync(session.service, store, store.get_state('history_id'))
+
+
+def scenario_open(session, store, options):
+    for message_id in store.get_ids()[:OPENED]:
+        load_body(session.service, store, message_id)
+
+
+def scenario_open_attachment(session, store, options):
+    with tempfile.TemporaryDirectory() as folder:
+        cache = AttachmentCache(folder)
+        for message_id in store.get_ids()[:OPENED]:
+            body, attachments = load_message(session.service, store, message_id)
+            if attachments:
+                cache.fetch(session, message_id, attachments[0])
+                return
+
+
+def scenario_send_small(session, store, options):
+    with tempfile.NamedTemporaryFile(suffix='.bin') as attachment:
+        attachment.write(os.urandom(100 * 1024))
+        attachment.flush()
+        message = build_raw_message('me@example.com', 'you@example.com', 'Benchmark', 'Hello', [attachment.name])
+        default_scheduler().execute(session.service.users().messages().send(userId='me', body=message), idempotent=False)
+
+
+def scenario_send_large(session, store, options):
+    with tempfile.NamedTemporaryFile(suffix='.bin') as attachment:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(options['attachment_mb']):
+            attachment.write(chunk)
+        attachment.flush()
+        with tempfile.TemporaryFile() as message_file:
+            write_message(message_file, 'me@example.com', 'you@example.com', 'Benchmark', 'Hello', [attachment.name])
+            message_file.seek(0)
+            send_message_stream(session.service, message_file)
+
+
+def scenario_accounts_load(session, store, options):
+    #the accounts share the connections of session, the bench store is left to the other scenarios
+    for index in range(options['accounts']):
+        account = Account(f'account{index}@example.com', None, pool=session.pool,
+                          store=MessageStore(f'{store.path}.account{index}'))
+        account.session = GmailSession(session.credentials, root_url=session.root_url, pool=session.pool)
+        full_sync(account.service, account.store, scheduler=account.scheduler)
+        load_headers(account.service, account.store, account.store.get_ids()[:BATCH_SIZE], account.scheduler)
+        account.close()
+
+
+SCENARIOS = {
+    'inbox_load': scenario_inbox_load,
+    'inbox_restart': scenario_inbox_restart,
+    'refresh_quiet': scenario_refresh,
+    'refresh_new_mail': scenario_refresh,
+    'open_message': scenario_open,
+    'open_cached': scenario_open,
+    'open_attachment': scenario_open_attachment,
+    'send_small': scenario_send_small,
+    'send_large': scenario_send_large,
+    'accounts_load': scenario_accounts_load,
+}
+
+
+def run_scenario(name, url, store_path, options):
+    #child process: run one scenario and print its wall time and peak RSS as json
+    store = MessageStore(store_path)
+    session = GmailSession(Credentials(token='benchmark'), root_url=url)
+    #the google libraries are imported when the service is first built, keep that out of the timings
+    session.service
+    start = time.perf_counter()
+    SCENARIOS[name](session, store, options)
+    wall = time.perf_counter() - start
+    session.close()
+    store.close()
+    #ru_maxrss is in kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    print(json.dumps({'wall_ms': wall * 1000, 'peak_rss_mb': peak_mb}))
+
+
+def control(url, action, **query):
+    params = '&'.join(f'{key}={value}' for key, value in query.items())
+    with urllib.request.urlopen(f'{url}__{action}?{params}') as response:
+        return json.loads(response.read())
+
+
+def bench_size(size, args):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'fake_gmail_server.py'), '--messages', str(size),
+         '--latency', str(args.latency), '--attachment-size', str(args.attachment_size),
+         '--rate-limit', str(args.rate_limit)],
+        stdout=subprocess.PIPE, text=True)
+    results = []
+    try:
+        url = server.stdout.readline().strip()
+        with tempfile.TemporaryDirectory() as folder:
+            store_path = os.path.join(folder, 'bench.db')
+            for name in args.scenarios:
+                if name == 'refresh_new_mail':
+                    control(url, 'inject', count=NEW_MAIL)
+                control(url, 'reset')
+                child = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--run', name, '--url', url, '--store', store_path,
+                     '--attachment-mb', str(args.attachment_mb), '--accounts', str(args.accounts)],
+                    capture_output=True, text=True)
+                if child.returncode != 0:
+                    raise RuntimeError(f'{name} failed:\n{child.stderr}')
+                measured = json.loads(child.stdout.strip().splitlines()[-1])
+                stats = control(url, 'stats')
+                results.append({'size': size, 'scenario': name, 'requests': stats['requests'],
+                                'batched_calls': stats['batched_calls'], 'bytes_out': stats['bytes_out'],
+                                'bytes_in': stats['bytes_in'], **measured})
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def print_table(results):
+    print(f"{'size':>8} {'scenario':<18}{'requests':>9}{'batched':>9}{'wall ms':>10}"
+          f"{'KB down':>10}{'KB up':>10}{'peak RSS MB':>13}")
+    for result in results:
+        print(f"{result['size']:>8} {result['scenario']:<18}{result['requests']:>9}{result['batched_calls']:>9}"
+              f"{result['wall_ms']:>10.1f}{result['bytes_out'] / 1024:>10.1f}{result['bytes_in'] / 1024:>10.1f}"
+              f"{result['peak_rss_mb']:>13.1f}")
+
+
+def compare(results, baseline_path, tolerance, counted=True):
+    #list the metrics that got worse than the baseline by more than tolerance
+    #counted False skips requests and bytes, which retries make differ from run to run
+    with open(baseline_path) as baseline_file:
+        baseline = {(result['size'], result['scenario']): result for result in json.load(baseline_file)}
+    regressions = []
+    for result in results:
+        before = baseline.get((result['size'], result['scenario']))
+        if before is None:
+            continue
+        for metric in METRICS:
+            #requests are exact, bytes nearly so, time and memory get the tolerance
+            if metric in ('wall_ms', 'peak_rss_mb'):
+                allowed = before[metric] * (1 + tolerance)
+            elif not counted:
+                continue
+            elif metric == 'requests':
+                allowed = before[metric]
+            else:
+                allowed = before[metric] * (1 + BYTES_TOLERANCE) + BYTES_SLACK
+            if result[metric] > allowed:
+                regressions.append(f"{result['size']} {result['scenario']} {metric}: "
+                                   f"{before[metric]:.1f} -> {result[metric]:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the mail client against a fake Gmail server')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated mailbox sizes')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every request')
+    parser.add_argument('--attachment-size', type=int, default=256 * 1024, help='bytes per received attachment')
+    parser.add_argument('--attachment-mb', type=int, default=20, help='attachment size of send_large')
+    parser.add_argument('--accounts', type=int, default=5, help='accounts started by accounts_load')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='fraction of calls the server answers with a 429')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios, in order')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown in time and memory')
+    #internal, used for the per scenario child processes
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--store', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_scenario(args.run, args.url, args.store, {'attachment_mb': args.attachment_mb, 'accounts': args.accounts})
+        return
+
+    args.scenarios = args.scenarios.split(',')
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        results.extend(bench_size(size, args))
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.compare:
+        #with injected 429s the retries change the requests and bytes of every run
+        regressions = compare(results, args.compare, args.tolerance, counted=not args.rate_limit)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,471 @@
+#local stand-in for the Gmail REST API, serving a synthetic mailbox
+#covers what the client uses: profile, messages list/get (metadata, full, raw), history,
+#attachments, batch requests and raw or resumable sends
+#every request is counted with the bytes it moved, see /__stats
+#run with: python benchmarks/fake_gmail_server.py --messages 10000 --latency 20
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sample_payloads import KINDS, WORDS, make_payload
+
+
+SENDERS = ['Ana Petrova <ana@example.com>', 'Ivan Georgiev <ivan@example.org>',
+           'Billing <billing@example.net>', 'Team Updates <updates@example.com>']
+
+
+def attachment_bytes(index, size):
+    #deterministic attachment content, cheap to produce at any size
+    block = bytes((index + offset) % 256 for offset in range(4096))
+    return (block * (size // len(block) + 1))[:size]
+
+
+class FakeMailbox:
+    def __init__(self, count, attachment_size=256 * 1024, seed=0):
+        self.lock = threading.Lock()
+        self.seed = seed
+        self.attachment_size = attachment_size
+        self.history_id = 1000
+        #message index -> set of labels, ids are derived from the index
+        self.labels = {}
+        #(history id, record) pairs, oldest first
+        self.history = []
+        #inbox ids, newest first
+        self.inbox = []
+        self.next_index = 0
+        self.add_messages(count, record=False)
+
+    @staticmethod
+    def message_id(index):
+        return f'{index:016x}'
+
+    @staticmethod
+    def message_index(message_id):
+        try:
+            return int(message_id, 16)
+        except ValueError:
+            return -1
+
+    def add_messages(self, count, record=True):
+        #new messages arrive in the inbox, newest on top
+        with self.lock:
+            new_ids = []
+            for _ in range(count):
+                index = self.next_index
+                self.next_index += 1
+                self.labels[index] = {'INBOX', 'UNREAD'}
+                new_ids.append(self.message_id(index))
+                if record:
+                    self.history_id += 1
+                    self.history.append((self.history_id, {
+                        'id': str(self.history_id),
+                        'messagesAdded': [{'message': {'id': self.message_id(index), 'labelIds': ['INBOX', 'UNREAD']}}]}))
+            self.inbox[:0] = reversed(new_ids)
+            return new_ids
+
+    def exists(self, message_id):
+        return self.message_index(message_id) in self.labels
+
+    def kind(self, index):
+        return KINDS[index % len(KINDS)]
+
+    def headers(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        subject = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 8))).capitalize()
+        day = 1 + index % 28
+        return [
+            {'name': 'Subject', 'value': f'{subject} #{index}'},
+            {'name': 'From', 'value': SENDERS[index % len(SENDERS)]},
+            {'name': 'To', 'value': 'me@example.com'},
+            {'name': 'Date', 'value': f'Mon, {day:02d} Jan 2024 10:{index % 60:02d}:00 +0000'},
+            {'name': 'Message-ID', 'value': f'<{index}@fake.example.com>'},
+        ]
+
+    def payload(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        payload = make_payload(self.kind(index), rng)
+        #point the attachment stubs at attachments this server can serve
+        for number, part in enumerate(part for part in payload.get('parts', []) if part.get('filename')):
+            part['body'] = {'size': self.attachment_size, 'attachmentId': f'{self.message_id(index)}-{number}'}
+        payload['headers'] = self.headers(index) + payload.get('headers', [])
+        return payload
+
+    def resource(self, message_id, message_format='full', metadata_headers=None):
+        index = self.message_index(message_id)
+        resource = {'id': message_id, 'threadId': message_id, 'labelIds': sorted(self.labels[index]),
+                    'historyId': str(self.history_id), 'internalDate': str(1704103200000 + index * 60000),
+                    'snippet': '', 'sizeEstimate': 4000}
+        if message_format == 'minimal':
+            return resource
+        if message_format == 'metadata':
+            headers = self.headers(index)
+            if metadata_headers:
+                wanted = {name.lower() for name in metadata_headers}
+                headers = [header for header in headers if header['name'].lower() in wanted]
+            resource['payload'] = {'mimeType': 'multipart/mixed', 'headers': headers}
+            return resource
+        if message_format == 'raw':
+            resource['raw'] = base64.urlsafe_b64encode(self.raw_message(index)).decode('ascii')
+            return resource
+        resource['payload'] = self.payload(index)
+        return resource
+
+    def raw_message(self, index):
+        #rfc822 source: the headers, the plain text and the attachments
+        payload = self.payload(index)
+        lines = [f"{header['name']}: {header['value']}" for header in self.headers(index)]
+        lines += ['MIME-Version: 1.0', 'Content-Type: multipart/mixed; boundary="b"', '', '--b',
+                  'Content-Type: text/plain; charset="utf-8"', '']
+        text = next((part for part in iter_parts(payload) if part.get('mimeType') == 'text/plain'), None)
+        if text is None:
+            text = next(part for part in iter_parts(payload) if part.get('mimeType') == 'text/html')
+        lines.append(base64.urlsafe_b64decode(text['body']['data'] + '==').decode('utf-8'))
+        for part in iter_parts(payload):
+            if part.get('filename'):
+                data = base64.encodebytes(attachment_bytes(index, self.attachment_size)).decode('ascii')
+                lines += ['--b', f"Content-Type: {part['mimeType']}", 'Content-Transfer-Encoding: base64',
+                          f'Content-Disposition: attachment; filename="{part["filename"]}"', '', data]
+        lines.append('--b--')
+        return '\r\n'.join(lines).encode('utf-8')
+
+    def attachment(self, message_id, attachment_id):
+        index = self.message_index(message_id)
+        data = attachment_bytes(index, self.attachment_size)
+        return {'attachmentId': attachment_id, 'size': len(data),
+                'data': base64.urlsafe_b64encode(data).decode('ascii')}
+
+
+def iter_parts(payload):
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get('parts', [])))
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.batched_calls = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.endpoints = {}
+
+    def record(self, endpoint, bytes_in, bytes_out, batched_calls=0):
+        with self.lock:
+            self.requests += 1
+            self.batched_calls += batched_calls
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': self.requests, 'batched_calls': self.batched_calls, 'bytes_in': self.bytes_in,
+                    'bytes_out': self.bytes_out, 'endpoints': dict(self.endpoints)}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message, reason=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+    def body(self):
+        error = {'code': self.status, 'message': str(self)}
+        if self.reason:
+            error['errors'] = [{'domain': 'usageLimits', 'reason': self.reason, 'message': str(self)}]
+        return {'error': error}
+
+
+class FakeGmailServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, mailbox, latency=0.0, fail_upload_chunk=0, rate_limit=0.0, seed=0):
+        super().__init__(address, FakeGmailHandler)
+        self.mailbox = mailbox
+        #seconds added to every http request, a batch pays it once
+        self.latency = latency
+        #when set, the nth upload chunk of every upload fails once with a 503
+        self.fail_upload_chunk = fail_upload_chunk
+        #fraction of api calls, batched ones included, answered with 429 rateLimitExceeded
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.stats = Stats()
+        self.uploads = {}
+        self.sent = 0
+
+    def handle_error(self, request, client_address):
+        #clients that drop a connection mid-reply are not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def rate_limited(self):
+        if not self.rate_limit:
+            return False
+        with self.random_lock:
+            return self.random.random() < self.rate_limit
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #replies go out as headers then body, without this small replies wait on delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        parts = urlsplit(self.path)
+        query = {key: values for key, values in parse_qs(parts.query).items()}
+
+        if parts.path.startswith('/__'):
+            return self.control(parts.path, query)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        batched_calls = 0
+        try:
+            if parts.path in ('/batch', '/batch/gmail/v1'):
+                status, headers, content = self.batch(body)
+                batched_calls = content.count(b'HTTP/1.1 ')
+                endpoint = 'batch'
+            elif parts.path.startswith('/upload/'):
+                status, headers, content = self.upload(method, parts.path, query, body)
+                endpoint = 'upload'
+            else:
+                status, result = self.dispatch(method, parts.path, query, body)
+                headers = {'Content-Type': 'application/json; charset=UTF-8'}
+                content = json.dumps(result).encode('utf-8')
+                endpoint = self.endpoint_name(parts.path)
+        except ApiError as e:
+            status, headers = e.status, {'Content-Type': 'application/json; charset=UTF-8'}
+            content = json.dumps(e.body()).encode('utf-8')
+            endpoint = 'error'
+
+        self.server.stats.record(endpoint, len(body), len(content), batched_calls)
+        self.reply(status, headers, content)
+
+    def reply(self, status, headers, content):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def control(self, path, query):
+        if path == '/__stats':
+            content = json.dumps(self.server.stats.snapshot()).encode('utf-8')
+        elif path == '/__reset':
+            self.server.stats.reset()
+            content = b'{}'
+        elif path == '/__inject':
+            new_ids = self.server.mailbox.add_messages(int(query.get('count', ['1'])[0]))
+            content = json.dumps({'ids': new_ids}).encode('utf-8')
+        else:
+            return self.reply(404, {}, b'')
+        self.reply(200, {'Content-Type': 'application/json'}, content)
+
+    @staticmethod
+    def endpoint_name(path):
+        segments = path.split('/')[5:]
+        if not segments:
+            return 'other'
+        if segments[0] == 'messages' and len(segments) > 1:
+            return 'messages.attachments.get' if 'attachments' in segments else f'messages.{"send" if segments[1] == "send" else "get"}'
+        return {'messages': 'messages.list', 'history': 'history.list', 'profile': 'getProfile'}.get(segments[0], segments[0])
+
+    def dispatch(self, method, path, query, body):
+        mailbox = self.server.mailbox
+        segments = path.split('/')
+        #/gmail/v1/users/{userId}/...
+        if segments[:4] != ['', 'gmail', 'v1', 'users'] or len(segments) < 6:
+            raise ApiError(404, 'Not Found')
+        resource = segments[5:]
+
+        if self.server.rate_limited():
+            raise ApiError(429, 'Rate Limit Exceeded', 'rateLimitExceeded')
+
+        if resource == ['profile']:
+            return 200, {'emailAddress': 'me@example.com', 'messagesTotal': len(mailbox.labels),
+                         'threadsTotal': len(mailbox.labels), 'historyId': str(mailbox.history_id)}
+
+        if resource == ['messages'] and method == 'GET':
+            page_size = min(int(query.get('maxResults', ['100'])[0]), 500)
+            start = int(query.get('pageToken', ['0'])[0])
+            with mailbox.lock:
+                page = mailbox.inbox[start:start + page_size]
+                more = start + page_size < len(mailbox.inbox)
+                total = len(mailbox.inbox)
+            result = {'messages': [{'id': message_id, 'threadId': message_id} for message_id in page],
+                      'resultSizeEstimate': total}
+            if more:
+                result['nextPageToken'] = str(start + page_size)
+            if 'fields' in query:
+                result.pop('resultSizeEstimate')
+                for message in result['messages']:
+                    message.pop('threadId')
+            return 200, result
+
+        if resource == ['messages', 'send'] and method == 'POST':
+            self.server.sent += 1
+            return 200, {'id': uuid.uuid4().hex[:16], 'threadId': uuid.uuid4().hex[:16], 'labelIds': ['SENT']}
+
+        if len(resource) == 2 and resource[0] == 'messages':
+            if not mailbox.exists(resource[1]):
+                raise ApiError(404, 'Requested entity was not found.')
+            return 200, mailbox.resource(resource[1], query.get('format', ['full'])[0], query.get('metadataHeaders'))
+
+        if len(resource) == 4 and resource[0] == 'messages' and resource[2] == 'attachments':
+            if not mailbox.exists(resource[1]):
+                raise ApiError(404, 'Requested entity was not found.')
+            return 200, mailbox.attachment(resource[1], resource[3])
+
+        if resource == ['history']:
+            start = int(query['startHistoryId'][0])
+            with mailbox.lock:
+                if mailbox.history and start < mailbox.history[0][0] - 1:
+                    raise ApiError(404, 'Requested entity was not found.')
+                records = [record for history_id, record in mailbox.history if history_id > start]
+                return 200, {'history': records, 'historyId': str(mailbox.history_id)}
+
+        raise ApiError(404, 'Not Found')
+
+    def batch(self, body):
+        #multipart/mixed of application/http parts, answered in kind
+        request = BytesParser(policy=HTTP).parsebytes(
+            f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('ascii') + body)
+        boundary = uuid.uuid4().hex
+        out = []
+        for part in request.iter_parts():
+            content_id = part['Content-ID'].strip('<>')
+            raw = part.get_payload(decode=True) or part.get_payload().encode('utf-8')
+            request_line = raw.split(b'\r\n', 1)[0].split(b'\n', 1)[0].decode('ascii')
+            method, target = request_line.split(' ')[:2]
+            parts = urlsplit(target)
+            try:
+                status, result = self.dispatch(method, parts.path, parse_qs(parts.query), b'')
+                reason = 'OK'
+            except ApiError as e:
+                status, result, reason = e.status, e.body(), 'Error'
+            content = json.dumps(result)
+            out.append(f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                       f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=UTF-8\r\n'
+                       f'Content-Length: {len(content.encode("utf-8"))}\r\n\r\n{content}\r\n')
+        out.append(f'--{boundary}--\r\n')
+        return 200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, ''.join(out).encode('utf-8')
+
+    def upload(self, method, path, query, body):
+        upload_type = query.get('uploadType', [''])[0]
+        sent = json.dumps({'id': uuid.uuid4().hex[:16], 'threadId': uuid.uuid4().hex[:16],
+                           'labelIds': ['SENT']}).encode('utf-8')
+        json_headers = {'Content-Type': 'application/json; charset=UTF-8'}
+
+        if upload_type != 'resumable':
+            #simple and multipart uploads carry the whole message in one request
+            self.server.sent += 1
+            return 200, json_headers, sent
+
+        upload_id = query.get('upload_id', [None])[0]
+        if upload_id is None:
+            #start of a resumable upload
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {'received': 0, 'chunks': 0, 'failed': False,
+                                              'total': int(self.headers.get('X-Upload-Content-Length') or -1)}
+            location = f'{self.server.url}{path.lstrip("/")}?uploadType=resumable&upload_id={upload_id}'
+            return 200, {'Location': location}, b''
+
+        upload = self.server.uploads.get(upload_id)
+        if upload is None:
+            raise ApiError(404, 'Upload session not found.')
+
+        content_range = self.headers.get('Content-Range', '')
+        total = content_range.rsplit('/', 1)[-1]
+        if total != '*':
+            upload['total'] = int(total)
+        if not content_range.startswith('bytes */'):
+            upload['chunks'] += 1
+            if (self.server.fail_upload_chunk and upload['chunks'] == self.server.fail_upload_chunk
+                    and not upload['failed']):
+                #drop this chunk, the client has to ask where to resume
+                upload['failed'] = True
+                raise ApiError(503, 'Backend Error')
+            upload['received'] += len(body)
+
+        if upload['received'] >= upload['total'] >= 0:
+            self.server.sent += 1
+            del self.server.uploads[upload_id]
+            return 200, json_headers, sent
+        headers = {'Range': f'bytes=0-{upload["received"] - 1}'} if upload['received'] else {}
+        return 308, headers, b''
+
+
+def serve(count, latency=0.0, attachment_size=256 * 1024, port=0, fail_upload_chunk=0, seed=0, rate_limit=0.0):
+    #start the server on a background thread and return it, server.shutdown() stops it
+    server = FakeGmailServer(('127.0.0.1', port), FakeMailbox(count, attachment_size, seed),
+                             latency=latency, fail_upload_chunk=fail_upload_chunk, rate_limit=rate_limit, seed=seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Gmail API server for benchmarks')
+    parser.add_argument('--messages', type=int, default=1000, help='messages in the inbox')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every request')
+    parser.add_argument('--attachment-size', type=int, default=256 * 1024, help='bytes per attachment')
+    parser.add_argument('--fail-upload-chunk', type=int, default=0, help='fail this upload chunk once with a 503')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='fraction of calls answered with a 429')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeGmailServer(('127.0.0.1', args.port), FakeMailbox(args.messages, args.attachment_size, args.seed),
+                             latency=args.latency / 1000, fail_upload_chunk=args.fail_upload_chunk,
+                             rate_limit=args.rate_limit, seed=args.seed)
+    #the benchmark harness reads the address from the first line
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#synthetic Gmail message payloads, shaped like messages().get responses with format='full'
+
+import base64
+import random
+
+
+WORDS = ('meeting report invoice project update schedule client budget review draft '
+         'deadline team weekly summary please attached thanks regards question').split()
+
+KINDS = ('plain', 'alternative', 'html', 'mixed')
+
+
+def encode(text):
+    #gmail style unpadded base64url
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def make_text(rng, paragraphs):
+    return '\n\n'.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))) for _ in range(paragraphs))
+
+
+def make_html(text):
+    paragraphs = ''.join(f'<p style="margin:0 0 8px">{paragraph}</p>' for paragraph in text.split('\n\n'))
+    return ('<html><head><style>p {font-family: Arial}</style></head>'
+            f'<body><div class="wrapper"><table><tr><td>{paragraphs}</td></tr></table></div></body></html>')
+
+
+def leaf(mime_type, text, filename=''):
+    return {'mimeType': mime_type, 'filename': filename,
+            'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}],
+            'body': {'size': len(text), 'data': encode(text)}}
+
+
+def attachment_stub(rng, index):
+    #attachments of full responses only carry an attachmentId
+    return {'mimeType': 'application/pdf', 'filename': f'report{index}.pdf',
+            'headers': [{'name': 'Content-Type', 'value': 'application/pdf'}],
+            'body': {'size': rng.randint(10000, 5000000), 'attachmentId': f'att{index}'}}
+
+
+def make_payload(kind, rng, paragraphs=5):
+    text = make_text(rng, paragraphs)
+    if kind == 'plain':
+        return leaf('text/plain', text)
+    if kind == 'html':
+        return {'mimeType': 'multipart/alternative', 'parts': [leaf('text/html', make_html(text))]}
+    alternative = {'mimeType': 'multipart/alternative',
+                   'parts': [leaf('text/plain', text), leaf('text/html', make_html(text))]}
+    if kind == 'alternative':
+        return alternative
+    #multipart/mixed with the text nested one level down and a couple of attachments
+    return {'mimeType': 'multipart/mixed',
+            'parts': [alternative] + [attachment_stub(rng, index) for index in range(2)]}
+
+
+def make_corpus(count, seed=0, paragraphs=5):
+    #(kind, payload) pairs cycling through every kind of message
+    rng = random.Random(seed)
+    return [(KINDS[index % len(KINDS)], make_payload(KINDS[index % len(KINDS)], rng, paragraphs))
+            for index in range(count)]
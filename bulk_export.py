@@ -0,0 +1,189 @@
+#headless bulk export of a whole mailbox, no GUI needed
+#message ids are listed page by page, raw messages are fetched by a bounded pool of workers
+#through a rate_limit.RequestScheduler, which keeps them under the per-user Gmail quota and
+#retries rate limited calls, and every message is written to disk as soon as it arrives
+#exported ids go to a checkpoint file, so running the same export again skips them
+#
+#run with: python bulk_export.py --format mbox --output archive.mbox
+#          python bulk_export.py --format maildir --output Archive --label INBOX --workers 8
+
+import argparse
+import base64
+import json
+import mailbox
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from accounts import command_line_session
+from gmail_fetch import list_message_ids
+from metrics import metrics, configure_logging
+from rate_limit import RequestScheduler, default_scheduler, QUOTA_UNITS_PER_SECOND
+
+
+FORMATS = ('mbox', 'maildir', 'jsonl')
+#parallel messages().get calls, the scheduler may let fewer of them run while gmail rate limits us
+EXPORT_WORKERS = 8
+
+
+def checkpoint_path(output, output_format):
+    #kept next to the export, one exported message id per line
+    if output_format == 'maildir':
+        return os.path.join(output, '.export_checkpoint')
+    return output + '.checkpoint'
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as checkpoint:
+        return {line.strip() for line in checkpoint if line.strip()}
+
+
+class MboxWriter:
+    #appends messages in mboxrd format, "From " lines inside messages are escaped
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+
+    def write(self, message):
+        raw = base64.urlsafe_b64decode(message['raw']).replace(b'\r\n', b'\n')
+        date = time.asctime(time.gmtime(int(message.get('internalDate', '0')) / 1000))
+        self.file.write(f'From MAILER-DAEMON {date}\n'.encode('ascii'))
+        lines = raw.split(b'\n')
+        if not lines[-1]:
+            #the message ends with a newline, which is not the start of one more line
+            lines.pop()
+        for line in lines:
+            if line.lstrip(b'>').startswith(b'From '):
+                line = b'>' + line
+            self.file.write(line + b'\n')
+        #the blank line that separates messages
+        self.file.write(b'\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MaildirWriter:
+    #one file per message, written to tmp/ and moved into new/ by the mailbox module
+    def __init__(self, path):
+        self.maildir = mailbox.Maildir(path, create=True)
+
+    def write(self, message):
+        self.maildir.add(base64.urlsafe_b64decode(message['raw']))
+
+    def close(self):
+        self.maildir.close()
+
+
+class JsonlWriter:
+    #one json object per line with the raw message still base64url encoded
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, message):
+        record = {key: message.get(key) for key in ('id', 'threadId', 'labelIds', 'internalDate', 'raw')}
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+WRITERS = {'mbox': MboxWriter, 'maildir': MaildirWriter, 'jsonl': JsonlWriter}
+
+
+def export_mailbox(session, output, output_format='mbox', label_id=None, workers=EXPORT_WORKERS,
+                   scheduler=None, progress=None):
+    #export every message of label_id (the whole mailbox when None) to output
+    #returns a dict with the number of messages exported, skipped and failed
+    #failed messages are not checkpointed, the next run tries them again
+    #scheduler defaults to the shared one, so an export started from the inbox shares its quota
+    scheduler = scheduler or default_scheduler()
+    checkpoint_file = checkpoint_path(output, output_format)
+    done = load_checkpoint(checkpoint_file)
+    writer = WRITERS[output_format](output)
+    counts = {'exported': 0, 'skipped': 0, 'failed': 0}
+
+    def fetch(message_id):
+        #runs on a worker thread, each of which has its own connection in the session
+        return scheduler.execute(session.service.users().messages().get(userId='me', id=message_id, format='raw'))
+
+    def collect(pending, wait_for):
+        #write finished messages on this thread, the writers never see two messages at once
+        finished, pending = wait(pending, return_when=wait_for)
+        for future in finished:
+            message_id = futures.pop(future)
+            try:
+                writer.write(future.result())
+            except Exception as e:
+                counts['failed'] += 1
+                print(f"Error exporting {message_id}: {str(e)}", file=sys.stderr)
+                continue
+            checkpoint.write(message_id + '\n')
+            counts['exported'] += 1
+        checkpoint.flush()
+        if progress is not None:
+            progress(counts)
+        return pending
+
+    futures = {}
+    try:
+        with open(checkpoint_file, 'a') as checkpoint, ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for page_ids in list_message_ids(session.service, label_id=label_id, scheduler=scheduler):
+                for message_id in page_ids:
+                    if message_id in done:
+                        counts['skipped'] += 1
+                        continue
+                    future = executor.submit(fetch, message_id)
+                    futures[future] = message_id
+                    pending.add(future)
+                    #keep a bounded number of messages in memory
+                    if len(pending) >= workers * 4:
+                        pending = collect(pending, FIRST_COMPLETED)
+            while pending:
+                pending = collect(pending, FIRST_COMPLETED)
+    finally:
+        writer.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a Gmail mailbox to mbox, Maildir or JSONL')
+    parser.add_argument('--output', required=True, help='file (mbox, jsonl) or folder (maildir) to write to')
+    parser.add_argument('--format', choices=FORMATS, default='mbox')
+    parser.add_argument('--label', default=None, help='only export this label, e.g. INBOX (default: everything)')
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS)
+    parser.add_argument('--quota', type=float, default=QUOTA_UNITS_PER_SECOND, help='quota units per second to use')
+    parser.add_argument('--account', help='address of the account to export (default: the first one signed in)')
+    parser.add_argument('--client-secrets', help='run the browser login with these client secrets if there is no token')
+    parser.add_argument('--metrics', help='write request counts and timings to this file (.json or .prom)')
+    args = parser.parse_args()
+    configure_logging()
+
+    user_email, session = command_line_session(args.account, args.client_secrets)
+    started = time.monotonic()
+
+    def report(counts):
+        elapsed = time.monotonic() - started
+        print(f"\rexported {counts['exported']}, skipped {counts['skipped']}, failed {counts['failed']} "
+              f"({counts['exported'] / max(elapsed, 1e-9):.1f} messages/s)", end='', file=sys.stderr)
+
+    try:
+        with metrics.timed('export', account=user_email, output_format=args.format):
+            counts = export_mailbox(session, args.output, args.format, args.label, args.workers,
+                                    RequestScheduler(args.quota, max_concurrency=args.workers), report)
+    finally:
+        session.close()
+        if args.metrics:
+            metrics.dump(args.metrics)
+    print(file=sys.stderr)
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#helpers for fetching message lists and headers from the Gmail API
+#headers are fetched with batch requests and format='metadata' so a refresh costs
+#about 1 + N/BATCH_SIZE round trips instead of one full message download per email
+#every request goes through a rate_limit.RequestScheduler, the shared one unless another is passed
+
+from googleapiclient.errors import HttpError
+
+from rate_limit import default_scheduler
+
+
+#headers shown in the inbox list
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+#gmail accepts up to 100 calls per batch but recommends staying at 50 or below
+BATCH_SIZE = 50
+#largest page of ids messages().list returns
+LIST_PAGE_SIZE = 500
+
+
+def get_header(headers, name, default):
+    #return the value of the first header with the given name
+    return next((header['value'] for header in headers if header['name'] == name), default)
+
+
+def message_row(message):
+    #turn a metadata response into the (id, subject, sender, date) row shown in the inbox
+    headers = message.get('payload', {}).get('headers', [])
+    subject = get_header(headers, 'Subject', 'No Subject')
+    sender = get_header(headers, 'From', 'Unknown Sender')
+    date = get_header(headers, 'Date', 'No Date')
+    return (message['id'], subject, sender, date)
+
+
+def list_message_ids(service, label_id='INBOX', page_size=LIST_PAGE_SIZE, scheduler=None):
+    #yield the ids of a label page by page, following nextPageToken through the whole mailbox
+    #label_id None lists every message; only the ids are requested so each page stays small
+    scheduler = scheduler or default_scheduler()
+    page_token = None
+    label_ids = [label_id] if label_id is not None else None
+    while True:
+        results = scheduler.execute(service.users().messages().list(
+            userId='me', labelIds=label_ids, maxResults=page_size, pageToken=page_token,
+            fields='messages/id,nextPageToken'))
+        yield [msg['id'] for msg in results.get('messages', [])]
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+
+def fetch_message_headers(service, message_ids, batch_size=BATCH_SIZE, scheduler=None):
+    #fetch Subject/From/Date for the given ids in batches
+    #returns a list of metadata responses in the same order as message_ids
+    #and a dictionary of id -> exception for the messages that could not be fetched
+    #calls answered with a rate limit or server error are retried by the scheduler
+    scheduler = scheduler or default_scheduler()
+    responses = {}
+    errors = {}
+
+    for start in range(0, len(message_ids), batch_size):
+        requests = [(message_id, service.users().messages().get(
+                        userId='me', id=message_id, format='metadata', metadataHeaders=METADATA_HEADERS))
+                    for message_id in message_ids[start:start + batch_size]]
+        batch_responses, batch_errors = scheduler.execute_batch(service, requests)
+        responses.update(batch_responses)
+        errors.update(batch_errors)
+
+    messages = [responses[message_id] for message_id in message_ids if message_id in responses]
+    return messages, errors
+
+
+#history record types that can change what the inbox shows
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+
+
+class HistoryExpired(Exception):
+    #raised when the stored historyId is too old and a full sync is needed
+    pass
+
+
+def get_history_id(service, scheduler=None):
+    #current historyId of the mailbox, taken before a full sync so no change is missed
+    scheduler = scheduler or default_scheduler()
+    return scheduler.execute(service.users().getProfile(userId='me'))['historyId']
+
+
+def get_email_address(service, scheduler=None):
+    #address of the account the service is signed in as
+    scheduler = scheduler or default_scheduler()
+    return scheduler.execute(service.users().getProfile(userId='me'))['emailAddress']
+
+
+def fetch_history_changes(service, start_history_id, label_id='INBOX', scheduler=None):
+    #fetch the changes since start_history_id that affect the given label
+    #returns (added_ids, removed_ids, history_id) with added_ids ordered newest first
+    scheduler = scheduler or default_scheduler()
+    changes = {}
+    page_token = None
+    history_id = start_history_id
+
+    while True:
+        try:
+            results = scheduler.execute(service.users().history().list(
+                userId='me', startHistoryId=start_history_id, historyTypes=HISTORY_TYPES,
+                pageToken=page_token))
+        except HttpError as e:
+            #gmail answers 404 once the start history id is no longer available
+            if e.resp.status == 404:
+                raise HistoryExpired(str(e))
+            raise
+
+        for record in results.get('history', []):
+            for item in record.get('messagesAdded', []):
+                if label_id in item['message'].get('labelIds', []):
+                    changes[item['message']['id']] = True
+            for item in record.get('messagesDeleted', []):
+                changes[item['message']['id']] = False
+            for item in record.get('labelsAdded', []):
+                if label_id in item.get('labelIds', []):
+                    changes[item['message']['id']] = True
+            for item in record.get('labelsRemoved', []):
+                if label_id in item.get('labelIds', []):
+                    changes[item['message']['id']] = False
+
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    #history is returned oldest first, the inbox shows newest first
+    added_ids = [message_id for message_id, added in reversed(list(changes.items())) if added]
+    removed_ids = [message_id for message_id, added in changes.items() if not added]
+    return added_ids, removed_ids, history_id
@@ -0,0 +1,214 @@
+#one authorized Gmail API client shared by every window
+#the discovery document is the static copy shipped with googleapiclient, parsed once per process,
+#and each thread gets its own keep-alive http connection because httplib2 is not thread safe
+#sessions of several accounts can share one ConnectionPool, so every account talks to gmail over
+#the same connection of a thread and only the authorization header differs
+#downloads too large to hold in memory go through a requests session that can stream responses
+#the google libraries take a good part of a second to import, so they are imported where they
+#are first needed, usually on a worker thread after the inbox is already on screen
+
+import json
+import os
+import threading
+import weakref
+
+from metrics import metrics
+
+
+#permissions the client asks for
+SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.compose', 'https://www.googleapis.com/auth/gmail.send']
+#where the OAuth token is cached between runs
+TOKEN_FILE = 'token.json'
+#address of the account the token belongs to, left by clients that knew only one account
+ACCOUNT_FILE = 'account.json'
+#seconds before a stalled request is abandoned
+HTTP_TIMEOUT = 60
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def load_token(token_file=TOKEN_FILE, scopes=SCOPES):
+    #cached credentials, refreshed without the browser flow when they have expired
+    #None when there is no usable token
+    if not os.path.exists(token_file):
+        return None
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+
+    with open(token_file, 'r') as token:
+        credentials_data = token.read()
+    if not credentials_data.strip():
+        return None
+
+    credentials = Credentials.from_authorized_user_info(json.loads(credentials_data), scopes)
+    if credentials.valid:
+        return credentials
+    if credentials.expired and credentials.refresh_token:
+        with metrics.timed('oauth.refresh'):
+            credentials.refresh(Request())
+        save_token(credentials, token_file)
+        return credentials
+    return None
+
+
+def save_token(credentials, token_file=TOKEN_FILE):
+    with open(token_file, 'w') as token:
+        token.write(credentials.to_json())
+
+
+def load_account(account_file=ACCOUNT_FILE):
+    #address of the last account that logged in, None if there is none
+    try:
+        with open(account_file, 'r') as account:
+            return json.load(account).get('email') or None
+    except (OSError, ValueError):
+        return None
+
+
+def discovery_document():
+    #parsed gmail v1 discovery document, None if googleapiclient does not ship one
+    global _discovery_document
+    from googleapiclient.discovery_cache import get_static_doc
+
+    with _discovery_lock:
+        if _discovery_document is None:
+            document = get_static_doc('gmail', 'v1')
+            if document is not None:
+                _discovery_document = json.loads(document)
+        return _discovery_document
+
+
+def metered(request):
+    #wrap an http request method to count the bytes each request sends and receives
+    def send(uri, method='GET', body=None, *args, **kwargs):
+        response, content = request(uri, method, body, *args, **kwargs)
+        metrics.count('http_requests_total')
+        metrics.count('http_bytes_sent_total', len(body) if isinstance(body, (bytes, str)) else 0)
+        metrics.count('http_bytes_received_total', len(content or b''))
+        return response, content
+    return send
+
+
+class _ThreadConnection:
+    #the connection of one thread, kept in the pool's thread local
+    #thread locals are dropped when their thread ends, which lets the pool release the connections
+    #of threads that are gone, e.g. those of an export or a mail merge that has finished
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class ConnectionPool:
+    #one keep-alive httplib2 connection per thread, shared by every session given the pool
+    #requests on a thread go out one after another, so sessions of different accounts can take turns on it
+    def __init__(self, timeout=HTTP_TIMEOUT):
+        self.timeout = timeout
+        self._local = threading.local()
+        #connections of the threads still running, by id of their _ThreadConnection
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def connection(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            from googleapiclient.http import build_http
+
+            #build_http stops httplib2 from treating the 308 of resumable uploads as a redirect
+            connection = build_http()
+            connection.timeout = self.timeout
+            holder = self._local.holder = _ThreadConnection(connection)
+            with self._lock:
+                self._connections[id(holder)] = connection
+            weakref.finalize(holder, self._release, id(holder))
+            metrics.count('http_connections_total')
+        return holder.connection
+
+    def _release(self, key):
+        #the thread that used the connection has ended
+        with self._lock:
+            connection = self._connections.pop(key, None)
+        if connection is not None:
+            connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._connections)
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+def default_pool():
+    #connections shared by the sessions of every account the client has open
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+class GmailSession:
+    def __init__(self, credentials, timeout=HTTP_TIMEOUT, root_url=None, pool=None):
+        self.credentials = credentials
+        self.timeout = timeout
+        #talk to another server than googleapis.com, e.g. the fake one the benchmarks run against
+        self.root_url = root_url
+        #a pool passed in belongs to the caller and outlives the session
+        self._owns_pool = pool is None
+        self.pool = pool if pool is not None else ConnectionPool(timeout)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._streaming = None
+
+    @property
+    def http(self):
+        #authorized wrapper around the keep-alive connection of the calling thread
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            from google_auth_httplib2 import AuthorizedHttp
+
+            http = AuthorizedHttp(self.credentials, http=self.pool.connection())
+            http.request = metered(http.request)
+            self._local.http = http
+        return http
+
+    @property
+    def service(self):
+        #Gmail API service of the calling thread, built without fetching the discovery document
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            from googleapiclient.discovery import build, build_from_document
+
+            document = discovery_document()
+            if document is not None:
+                if self.root_url is not None:
+                    document = dict(document, rootUrl=self.root_url)
+                service = build_from_document(document, http=self.http)
+            else:
+                service = build('gmail', 'v1', http=self.http, static_discovery=True)
+            self._local.service = service
+        return service
+
+    @property
+    def streaming(self):
+        #authorized requests session for responses read in chunks, its connection pool is thread safe
+        from google.auth.transport.requests import AuthorizedSession
+
+        with self._lock:
+            if self._streaming is None:
+                self._streaming = AuthorizedSession(self.credentials)
+            return self._streaming
+
+    def close(self):
+        with self._lock:
+            streaming, self._streaming = self._streaming, None
+        if self._owns_pool:
+            self.pool.close()
+        if streaming is not None:
+            streaming.close()
@@ -0,0 +1,171 @@
+#attachments of received emails, listed from the message payload and downloaded only when asked for
+#messages().get with format='full' names every attachment without its data, so opening an email
+#costs the same whatever is attached; a download streams the attachments().get response and decodes
+#the base64url data chunk by chunk into a file, so memory use does not grow with the attachment
+#downloaded files are kept per account and served from disk the next time
+#the http libraries are imported by the first download
+
+import base64
+import itertools
+import os
+import re
+import threading
+
+from googleapiclient.errors import HttpError
+
+from mail_body import iter_parts
+from message_store import STORE_DIR
+from metrics import metrics
+from rate_limit import default_scheduler, request_units
+
+
+#bytes read from the response per step
+DOWNLOAD_CHUNK = 64 * 1024
+
+_DATA_FIELD = re.compile(rb'"data"\s*:\s*"')
+_UNSAFE_FILENAME = re.compile(r'[^\w.\- ]+')
+
+
+def list_attachments(payload):
+    #parts of a format='full' payload that carry a file name, in document order
+    #the data of small parts comes inline, larger ones only have an attachmentId
+    attachments = []
+    for part in iter_parts(payload):
+        body = part.get('body', {})
+        if not part.get('filename') or not (body.get('attachmentId') or body.get('data')):
+            continue
+        #gmail numbers parts like 0, 1, 1.0, fall back to the position for payloads without partId
+        attachment = {'part_id': part.get('partId') or str(len(attachments)), 'filename': part['filename'],
+                      'mime_type': part.get('mimeType', 'application/octet-stream'), 'size': body.get('size', 0),
+                      'attachment_id': body.get('attachmentId')}
+        if body.get('data'):
+            attachment['data'] = body['data']
+        attachments.append(attachment)
+    return attachments
+
+
+def format_size(size):
+    if size < 1024:
+        return f'{size} bytes'
+    if size < 1024 * 1024:
+        return f'{size / 1024:.1f} KB'
+    return f'{size / (1024 * 1024):.1f} MB'
+
+
+def default_attachment_dir(user_email):
+    #downloaded attachments of an account, next to its message store
+    name = user_email.strip() or 'default'
+    return os.path.join(STORE_DIR, 'attachments', name)
+
+
+def write_data_field(chunks, out):
+    #decode the "data" string of a streamed attachments().get response into out
+    #only the undecoded tail of the string, under 4 characters, is held between chunks
+    chunks = iter(chunks)
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        match = _DATA_FIELD.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+        #keep enough of the end for a field name split over two chunks
+        buffer = buffer[-16:]
+    else:
+        raise ValueError('attachment response has no data')
+
+    pending = b''
+    for chunk in itertools.chain([buffer], chunks):
+        end = chunk.find(b'"')
+        if end >= 0:
+            chunk = chunk[:end]
+        pending += chunk
+        whole = len(pending) - len(pending) % 4
+        out.write(base64.urlsafe_b64decode(pending[:whole]))
+        pending = pending[whole:]
+        if end >= 0:
+            break
+    else:
+        raise ValueError('attachment response ended inside the data')
+    if pending:
+        out.write(base64.urlsafe_b64decode(pending + b'=' * (-len(pending) % 4)))
+
+
+class AttachmentCache:
+    #downloaded attachments under folder/<message id>/<part id>_<file name>
+    #files are keyed by part: gmail hands out a new attachmentId every time a message is fetched,
+    #the part id of an attachment stays the same
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        #one lock per file, two requests for the same attachment download it once
+        self._file_locks = {}
+
+    def path(self, message_id, attachment):
+        filename = _UNSAFE_FILENAME.sub('_', os.path.basename(attachment['filename'])) or 'attachment'
+        return os.path.join(self.folder, message_id, f"{attachment['part_id']}_{filename}")
+
+    def get(self, message_id, attachment):
+        #path of the downloaded file, None when it has not been downloaded
+        path = self.path(message_id, attachment)
+        return path if os.path.exists(path) else None
+
+    def fetch(self, session, message_id, attachment, scheduler=None):
+        #path of the attachment on disk, downloaded first if needed; runs on a worker thread
+        path = self.path(message_id, attachment)
+        with self._lock:
+            file_lock = self._file_locks.setdefault(path, threading.Lock())
+        with file_lock:
+            cached = os.path.exists(path)
+            metrics.cache('attachments', cached)
+            if not cached:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with metrics.timed('attachment.download', size=attachment['size']):
+                    download_attachment(session, message_id, attachment, path, scheduler)
+        return path
+
+
+def _metered(chunks):
+    metrics.count('http_requests_total')
+    for chunk in chunks:
+        metrics.count('http_bytes_received_total', len(chunk))
+        yield chunk
+
+
+def download_attachment(session, message_id, attachment, path, scheduler=None):
+    #write the attachment to path, through a temporary file so a broken download leaves nothing behind
+    import httplib2
+    import requests
+
+    partial = path + '.part'
+    if 'data' in attachment:
+        with open(partial, 'wb') as out:
+            data = attachment['data'].encode('ascii')
+            out.write(base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4)))
+        os.replace(partial, path)
+        return
+
+    scheduler = scheduler or default_scheduler()
+    request = session.service.users().messages().attachments().get(
+        userId='me', messageId=message_id, id=attachment['attachment_id'])
+
+    def stream():
+        #the request is built by the api client and sent through a session that does not read the body at once
+        try:
+            with session.streaming.get(request.uri, stream=True, timeout=session.timeout) as response:
+                if response.status_code >= 400:
+                    raise HttpError(httplib2.Response({'status': response.status_code}), response.content,
+                                    uri=request.uri)
+                with open(partial, 'wb') as out:
+                    write_data_field(_metered(response.iter_content(DOWNLOAD_CHUNK)), out)
+        except requests.RequestException as e:
+            #retried by the scheduler like any other dropped connection
+            raise ConnectionError(str(e)) from e
+
+    try:
+        scheduler.call(stream, request_units(request), method=request.methodId)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, path)
@@ -0,0 +1,99 @@
+#extracting readable text from Gmail message payloads
+#the MIME tree is walked by mimeType and text/plain is preferred; html is only converted
+#to text, with a streaming parser and no document tree, when a message has no plain part
+
+import base64
+import re
+from html.parser import HTMLParser
+
+
+#tags whose text is never shown
+SKIPPED_TAGS = {'script', 'style', 'head', 'title'}
+#tags that start a new line in the text version
+BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'ul', 'ol', 'table', 'blockquote', 'pre', 'hr',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+_SPACES = re.compile(r'[ \t\r\f\v\xa0]+')
+_BLANK_LINES = re.compile(r'\n\s*\n\s*\n+')
+
+
+def decode_data(data, charset='utf-8'):
+    #gmail sends part bodies as unpadded base64url
+    raw = base64.urlsafe_b64decode(data.encode('ascii') + b'=' * (-len(data) % 4))
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def part_charset(part):
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = _CHARSET.search(header['value'])
+            if match:
+                return match.group(1)
+    return 'utf-8'
+
+
+def iter_parts(payload):
+    #every part of the MIME tree, depth first and in document order
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get('parts', [])))
+
+
+def find_part(payload, mime_type):
+    #first inline part of the given type that carries its data in the payload
+    for part in iter_parts(payload):
+        if part.get('mimeType') == mime_type and not part.get('filename') and part.get('body', {}).get('data'):
+            return part
+    return None
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.chunks.append(data)
+
+
+def html_to_text(html):
+    #text content of an html document, parsed as a stream of tags
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    text = _SPACES.sub(' ', ''.join(extractor.chunks))
+    text = '\n'.join(line.strip() for line in text.split('\n'))
+    return _BLANK_LINES.sub('\n\n', text).strip()
+
+
+def extract_body(payload, default='No Content'):
+    #readable body of a message payload from messages().get with format='full'
+    part = find_part(payload, 'text/plain')
+    if part is not None:
+        return decode_data(part['body']['data'], part_charset(part))
+
+    part = find_part(payload, 'text/html')
+    if part is not None:
+        return html_to_text(decode_data(part['body']['data'], part_charset(part)))
+
+    return default
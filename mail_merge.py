@@ -0,0 +1,289 @@
+#mail merge: one email, with each recipient's fields filled in, sent to everyone listed in a csv file
+#the attachments are read and base64 encoded once; every message is its own headers and text part
+#followed by the same encoded bytes, which the upload reads without copying them per message
+#sends go out from a bounded pool of workers through a rate_limit.RequestScheduler, so a campaign
+#runs as fast as the per-user send quota allows instead of one round trip after the other
+#every outcome is appended to a csv log: running the same campaign again skips the recipients
+#already sent and tries the failed ones again
+#
+#templates name csv columns in braces, e.g. "Hello {name}"; the recipient address is in the email column
+#
+#run with: python mail_merge.py --recipients list.csv --subject "Notice for {name}" --body body.txt --attach notice.pdf
+
+import argparse
+import bisect
+import csv
+import io
+import itertools
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import getaddresses
+
+from accounts import command_line_session
+from metrics import metrics, configure_logging
+from mime_stream import (LARGE_MESSAGE_THRESHOLD, closing_delimiter, delimiter, encode_attachment, new_boundary,
+                         send_message_stream, write_head)
+from rate_limit import MAX_CONCURRENCY, QUOTA_UNITS_PER_SECOND, RequestScheduler, default_scheduler
+
+
+#column holding the recipient address
+RECIPIENT_FIELD = 'email'
+#parallel sends, the scheduler keeps them within quota and may let fewer run while gmail rate limits us
+MERGE_WORKERS = MAX_CONCURRENCY
+LOG_COLUMNS = ['time', 'email', 'status', 'message_id', 'error']
+
+_FIELD = re.compile(r'\{(\w+)\}')
+
+
+def read_recipients(path):
+    #one dict of fields per row of a csv file with a header line, rows without an address are left out
+    with open(path, 'r', newline='', encoding='utf-8-sig') as recipients_file:
+        reader = csv.DictReader(recipients_file)
+        columns = [name.strip() for name in reader.fieldnames or ()]
+        column = next((name for name in columns if name.lower() == RECIPIENT_FIELD), None)
+        if column is None:
+            raise ValueError(f"{path} has no '{RECIPIENT_FIELD}' column")
+        recipients = []
+        for row in reader:
+            fields = {name.strip(): (value or '').strip() for name, value in row.items() if name is not None}
+            fields[RECIPIENT_FIELD] = fields[column]
+            if fields[RECIPIENT_FIELD]:
+                recipients.append(fields)
+    return recipients
+
+
+def single_address(value):
+    #the address of a cell that names exactly one recipient, None for anything else,
+    #so "a@x.com, b@y.com" does not send one email to both
+    addresses = getaddresses([value])
+    if len(addresses) != 1 or '\r' in value or '\n' in value:
+        return None
+    address = addresses[0][1]
+    local, at, domain = address.rpartition('@')
+    if not local or not domain or any(character.isspace() for character in address):
+        return None
+    return address
+
+
+def template_fields(template):
+    return set(_FIELD.findall(template))
+
+
+def check_fields(templates, recipients):
+    #fail before anything is sent when a template names a column the csv does not have
+    columns = set(recipients[0]) if recipients else set()
+    missing = set().union(*(template_fields(template) for template in templates)) - columns
+    if missing:
+        raise ValueError(f"unknown fields in the template: {', '.join(sorted(missing))}")
+
+
+def render(template, fields):
+    return _FIELD.sub(lambda match: fields[match.group(1)], template)
+
+
+def merge_log_path(recipients_path):
+    #kept next to the recipient list
+    return os.path.splitext(recipients_path)[0] + '_sent.csv'
+
+
+def load_log(path):
+    #addresses the log records as sent
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r', newline='', encoding='utf-8') as log_file:
+        return {row['email'] for row in csv.DictReader(log_file) if row.get('status') == 'sent'}
+
+
+class SegmentReader:
+    #read only file object over a list of byte strings, so every email can share the attachment bytes
+    #it has what the upload needs: read, seek and tell
+    def __init__(self, segments):
+        self.segments = [segment for segment in segments if segment]
+        self.starts = list(itertools.accumulate((len(segment) for segment in self.segments), initial=0))
+        self.size = self.starts[-1]
+        self.position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        chunks = []
+        index = bisect.bisect_right(self.starts, self.position) - 1
+        while self.position < end:
+            start = self.starts[index]
+            chunk = self.segments[index][self.position - start:end - start]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            index += 1
+        return b''.join(chunks)
+
+
+def message_segments(sender, receiver, subject, body, parts):
+    #the email as a list of byte strings, parts are encoded attachment parts shared by every email
+    boundary = new_boundary()
+    head = io.BytesIO()
+    write_head(head, sender, receiver, subject, body, boundary)
+    segments = [head.getvalue()]
+    for part in parts:
+        segments += [delimiter(boundary), part]
+    segments.append(closing_delimiter(boundary))
+    return segments
+
+
+def send_segments(service, segments, scheduler):
+    #send one email as message/rfc822 media, the bytes are not base64url encoded a second time
+    #a send is not idempotent, the scheduler only retries it when gmail refused it for the rate
+    from googleapiclient.http import MediaIoBaseUpload
+
+    message = SegmentReader(segments)
+    if message.size > LARGE_MESSAGE_THRESHOLD:
+        return send_message_stream(service, message, scheduler=scheduler)
+    media = MediaIoBaseUpload(message, mimetype='message/rfc822', resumable=False)
+    return scheduler.execute(service.users().messages().send(userId='me', body={}, media_body=media),
+                             idempotent=False)
+
+
+def send_campaign(session, sender, recipients, subject, body, log_path, attachments=(),
+                  workers=MERGE_WORKERS, scheduler=None, progress=None):
+    #send subject and body, filled in with each recipient's fields, to every recipient
+    #returns a dict with the number of emails sent, skipped (sent before or listed twice) and failed
+    #failed recipients are logged but not marked sent, so the next run tries them again,
+    #rows whose address is not exactly one address fail without being sent
+    #progress, if given, is called with the counts after sends finish and may raise to stop the campaign
+    scheduler = scheduler or default_scheduler()
+    check_fields([subject, body], recipients)
+    done = load_log(log_path)
+    with metrics.timed('merge.encode', attachments=len(attachments)):
+        parts = [encode_attachment(attachment) for attachment in attachments]
+    counts = {'sent': 0, 'skipped': 0, 'failed': 0}
+
+    def send(fields):
+        #runs on a worker thread, each of which has its own connection in the session
+        segments = message_segments(sender, fields[RECIPIENT_FIELD], render(subject, fields),
+                                    render(body, fields), parts)
+        return send_segments(session.service, segments, scheduler)
+
+    def record(future):
+        #write the outcome of a send on this thread, the log never sees two rows at once
+        address = futures.pop(future)[RECIPIENT_FIELD]
+        try:
+            message = future.result()
+        except Exception as e:
+            fail(address, str(e))
+            return
+        counts['sent'] += 1
+        metrics.count('merge_messages_total', status='sent')
+        log.writerow([time.strftime('%Y-%m-%dT%H:%M:%S'), address, 'sent', (message or {}).get('id', ''), ''])
+
+    def fail(address, error):
+        counts['failed'] += 1
+        metrics.count('merge_messages_total', status='failed')
+        log.writerow([time.strftime('%Y-%m-%dT%H:%M:%S'), address, 'failed', '', error])
+
+    def collect(pending, wait_for):
+        finished, pending = wait(pending, return_when=wait_for)
+        for future in finished:
+            record(future)
+        log_file.flush()
+        if progress is not None:
+            progress(counts)
+        return pending
+
+    futures = {}
+    new_log = not os.path.exists(log_path)
+    with open(log_path, 'a', newline='', encoding='utf-8') as log_file:
+        log = csv.writer(log_file)
+        if new_log:
+            log.writerow(LOG_COLUMNS)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            pending = set()
+            queued = set()
+            for fields in recipients:
+                address = fields[RECIPIENT_FIELD]
+                if address in done or address in queued:
+                    counts['skipped'] += 1
+                    continue
+                if single_address(address) is None:
+                    fail(address, 'not a single email address')
+                    continue
+                queued.add(address)
+                future = executor.submit(send, fields)
+                futures[future] = fields
+                pending.add(future)
+                #keep a bounded number of sends queued, so a stopped campaign has little to drop
+                if len(pending) >= workers * 2:
+                    pending = collect(pending, FIRST_COMPLETED)
+            while pending:
+                pending = collect(pending, FIRST_COMPLETED)
+        finally:
+            #when stopped, sends not started are dropped and those under way are still logged,
+            #so the next run neither repeats nor forgets them
+            for future in list(futures):
+                if future.cancel():
+                    futures.pop(future)
+            for future in wait(list(futures)).done:
+                record(future)
+            executor.shutdown()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send one email with per-recipient fields to everyone in a csv file')
+    parser.add_argument('--recipients', required=True, help=f"csv file with a header line and an '{RECIPIENT_FIELD}' column")
+    parser.add_argument('--subject', required=True, help='subject template, e.g. "Notice for {name}"')
+    parser.add_argument('--body', required=True, help='text file with the body template')
+    parser.add_argument('--attach', action='append', default=[], help='file attached to every email, repeatable')
+    parser.add_argument('--sender', help='From address (default: the address of the account)')
+    parser.add_argument('--log', help='progress and result log (default: <recipients>_sent.csv)')
+    parser.add_argument('--workers', type=int, default=MERGE_WORKERS)
+    parser.add_argument('--quota', type=float, default=QUOTA_UNITS_PER_SECOND, help='quota units per second to use')
+    parser.add_argument('--account', help='address of the account to send from (default: the first one signed in)')
+    parser.add_argument('--client-secrets', help='run the browser login with these client secrets if there is no token')
+    parser.add_argument('--metrics', help='write request counts and timings to this file (.json or .prom)')
+    args = parser.parse_args()
+    configure_logging()
+
+    recipients = read_recipients(args.recipients)
+    with open(args.body, 'r', encoding='utf-8') as body_file:
+        body = body_file.read()
+    try:
+        check_fields([args.subject, body], recipients)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    user_email, session = command_line_session(args.account, args.client_secrets)
+    scheduler = RequestScheduler(args.quota, max_concurrency=args.workers)
+    started = time.monotonic()
+
+    def report(counts):
+        elapsed = time.monotonic() - started
+        print(f"\rsent {counts['sent']} of {len(recipients)}, skipped {counts['skipped']}, failed {counts['failed']} "
+              f"({counts['sent'] / max(elapsed, 1e-9):.1f} emails/s)", end='', file=sys.stderr)
+
+    try:
+        sender = args.sender or user_email
+        with metrics.timed('merge', recipients=len(recipients), attachments=len(args.attach)):
+            counts = send_campaign(session, sender, recipients, args.subject, body,
+                                   args.log or merge_log_path(args.recipients), args.attach, args.workers,
+                                   scheduler, report)
+    finally:
+        session.close()
+        if args.metrics:
+            metrics.dump(args.metrics)
+    print(file=sys.stderr)
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#keeping a MessageStore in step with the mailbox
+#these run on worker threads and never touch wx, so the inbox window, the benchmarks
+#and command line tools all load mail the same way
+#scheduler is the rate_limit.RequestScheduler to send requests through, None for the shared one
+
+from gmail_fetch import (fetch_message_headers, message_row, list_message_ids,
+                         get_history_id, fetch_history_changes, HistoryExpired)
+from mail_attachments import list_attachments
+from mail_body import extract_body
+from metrics import metrics
+from rate_limit import default_scheduler
+
+
+def full_sync(service, store, on_page=None, scheduler=None):
+    #list every inbox id and replace the stored inbox with them
+    #headers are not fetched here, they are loaded as rows are shown
+    #on_page, if given, is called after each page of ids and may raise to stop the sync
+    #remember where the mailbox history stands before listing it
+    history_id = get_history_id(service, scheduler=scheduler)
+
+    message_ids = []
+    for page_ids in list_message_ids(service, scheduler=scheduler):
+        message_ids.extend(page_ids)
+        if on_page is not None:
+            on_page(page_ids)
+
+    store.replace_ids(message_ids)
+    store.set_state('history_id', history_id)
+    return {'full': True, 'ids': message_ids, 'history_id': history_id}
+
+
+def incremental_sync(service, store, history_id, on_page=None, scheduler=None):
+    #apply the changes since history_id, falls back to a full sync once it has expired
+    try:
+        added_ids, removed_ids, history_id = fetch_history_changes(service, history_id, scheduler=scheduler)
+    except HistoryExpired:
+        return full_sync(service, store, on_page, scheduler)
+
+    known_ids = store.known_ids(added_ids)
+    added_ids = [message_id for message_id in added_ids if message_id not in known_ids]
+    messages, errors = fetch_message_headers(service, added_ids, scheduler=scheduler)
+    rows = [message_row(message) for message in messages]
+    if errors:
+        #some headers are missing, let the next full sync pick them up
+        history_id = None
+
+    store.remove_rows(removed_ids)
+    store.add_rows(rows)
+    store.set_state('history_id', history_id)
+    return {'full': False, 'rows': rows, 'removed_ids': removed_ids, 'history_id': history_id}
+
+
+def load_headers(service, store, message_ids, scheduler=None):
+    #(rows, failed ids): (id, subject, sender, date) rows from the store, missing ones fetched in
+    #batches and stored, and the ids gmail did not return, e.g. messages deleted since the last sync
+    #with service None only the rows in the store are returned
+    cached = store.get_headers(message_ids)
+    missing = [message_id for message_id in message_ids if message_id not in cached]
+    rows = [(message_id,) + cached[message_id] for message_id in message_ids if message_id in cached]
+    failed_ids = []
+    metrics.cache('store_headers', True, len(rows))
+    metrics.cache('store_headers', False, len(missing))
+    if missing and service is not None:
+        messages, errors = fetch_message_headers(service, missing, scheduler=scheduler)
+        fetched = [message_row(message) for message in messages]
+        store.put_headers(fetched)
+        rows.extend(fetched)
+        failed_ids = list(errors)
+    return rows, failed_ids
+
+
+def load_message(service, store, message_id, scheduler=None):
+    #(body, attachments) of a message, from the store or else fetched and stored
+    #attachments are only listed here, their data is downloaded by mail_attachments when asked for
+    body = store.get_body(message_id)
+    attachments = store.get_attachments(message_id)
+    metrics.cache('store_bodies', body is not None and attachments is not None)
+    if body is None or attachments is None:
+        scheduler = scheduler or default_scheduler()
+        message = scheduler.execute(service.users().messages().get(userId='me', id=message_id))
+        with metrics.timed('body.extract', message_id=message_id):
+            body = extract_body(message['payload'])
+            attachments = list_attachments(message['payload'])
+        store.put_attachments(message_id, attachments)
+        store.put_body(message_id, body)
+    return body, attachments
+
+
+def load_body(service, store, message_id, scheduler=None):
+    #readable body of a message, from the store or else fetched and stored
+    return load_message(service, store, message_id, scheduler)[0]
@@ -0,0 +1,264 @@
+#local on-disk cache of the inbox, kept in SQLite under the user's profile
+#header rows let the inbox show up without a network round trip,
+#decoded bodies are kept up to a size budget and evicted least recently used first,
+#together with the list of attachments of the message,
+#and subject, sender and body text go into a full-text index for offline search
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+#folder holding one database per account
+STORE_DIR = os.path.join(os.path.expanduser('~'), '.mail_client')
+#default size budget for cached bodies, in bytes
+BODY_CACHE_BUDGET = 50 * 1024 * 1024
+#environment variable with the budget of each account's store in megabytes, e.g. MAIL_CLIENT_BODY_BUDGET=200
+BODY_BUDGET_VARIABLE = 'MAIL_CLIENT_BODY_BUDGET'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    subject TEXT,
+    sender TEXT,
+    date TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_seq ON messages (seq);
+CREATE TABLE IF NOT EXISTS bodies (
+    id TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bodies_last_access ON bodies (last_access);
+CREATE TABLE IF NOT EXISTS attachments (
+    id TEXT PRIMARY KEY,
+    parts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS search_docs (
+    docid INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT UNIQUE NOT NULL
+);
+"""
+
+#full-text index, its rowid is the docid of the message in search_docs
+#the body text stays indexed after the cached body itself has been evicted
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(subject, sender, body, tokenize='unicode61 remove_diacritics 2');
+"""
+
+#most results a search returns
+SEARCH_LIMIT = 1000
+
+_SEARCH_TERM = re.compile(r'\S+')
+
+
+def search_expression(query):
+    #turn what the user typed into an fts5 query: every word must match, as a prefix
+    terms = ['"' + term.replace('"', '""') + '"*' for term in _SEARCH_TERM.findall(query)]
+    return ' '.join(terms)
+
+
+def body_budget():
+    #size budget for cached bodies in bytes, BODY_CACHE_BUDGET unless the environment sets another one
+    value = os.environ.get(BODY_BUDGET_VARIABLE, '').strip()
+    try:
+        budget = int(float(value) * 1024 * 1024)
+    except (ValueError, OverflowError):
+        return BODY_CACHE_BUDGET
+    return budget if budget >= 0 else BODY_CACHE_BUDGET
+
+
+def default_store_path(user_email):
+    #one database file per account, 'default' when the address is not known
+    name = user_email.strip() or 'default'
+    return os.path.join(STORE_DIR, f'{name}.db')
+
+
+class MessageStore:
+    def __init__(self, path, body_budget=BODY_CACHE_BUDGET):
+        self.path = path
+        self.body_budget = body_budget
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        #the store is shared between the ui and background threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+            #search needs sqlite built with fts5, the rest of the store works without it
+            try:
+                self.conn.executescript(SEARCH_SCHEMA)
+                self.searchable = True
+            except sqlite3.OperationalError:
+                self.searchable = False
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_ids(self):
+        #ids of the inbox, newest first
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT id FROM messages ORDER BY seq DESC')]
+
+    def get_headers(self, message_ids):
+        #id -> (subject, sender, date) for the given ids whose headers are known
+        headers = {}
+        with self.lock:
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                for message_id, subject, sender, date in self.conn.execute(
+                        f'SELECT id, subject, sender, date FROM messages WHERE id IN ({placeholders}) AND subject IS NOT NULL',
+                        chunk):
+                    headers[message_id] = (subject, sender, date)
+        return headers
+
+    def known_ids(self, message_ids):
+        #the given ids that are already in the inbox
+        known = set()
+        with self.lock:
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                known.update(row[0] for row in self.conn.execute(
+                    f'SELECT id FROM messages WHERE id IN ({placeholders})', chunk))
+        return known
+
+    def put_headers(self, rows):
+        #fill in the headers of ids already in the inbox
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'UPDATE messages SET subject = ?, sender = ?, date = ? WHERE id = ?',
+                [tuple(row[1:]) + (row[0],) for row in rows])
+            for message_id, subject, sender, date in rows:
+                self._index(message_id, subject=subject, sender=sender)
+
+    def replace_ids(self, message_ids):
+        #replace the inbox after a full sync, ids are given newest first
+        #headers already known for ids that are still in the inbox are kept
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY, seq INTEGER NOT NULL)')
+            self.conn.execute('DELETE FROM listed')
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO listed (id, seq) VALUES (?, ?)',
+                [(message_id, len(message_ids) - index) for index, message_id in enumerate(message_ids)])
+            self.conn.execute('DELETE FROM messages WHERE id NOT IN (SELECT id FROM listed)')
+            self.conn.execute(
+                'INSERT INTO messages (id, seq) SELECT id, seq FROM listed WHERE true '
+                'ON CONFLICT (id) DO UPDATE SET seq = excluded.seq')
+            self._purge_index()
+
+    def add_rows(self, rows):
+        #put new rows, given newest first, on top of the inbox
+        with self.lock, self.conn:
+            top = self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM messages').fetchone()[0]
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO messages (id, seq, subject, sender, date) VALUES (?, ?, ?, ?, ?)',
+                [(row[0], top + len(rows) - index) + tuple(row[1:]) for index, row in enumerate(rows)])
+            for message_id, subject, sender, date in rows:
+                self._index(message_id, subject=subject, sender=sender)
+
+    def remove_rows(self, message_ids):
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM messages WHERE id = ?', [(message_id,) for message_id in message_ids])
+            self._purge_index()
+
+    def get_body(self, message_id):
+        #cached body text or None, a hit makes the body the most recently used
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT body FROM bodies WHERE id = ?', (message_id,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE bodies SET last_access = ? WHERE id = ?', (time.time(), message_id))
+            return row[0]
+
+    def put_body(self, message_id, body):
+        size = len(body.encode('utf-8'))
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO bodies (id, body, size, last_access) VALUES (?, ?, ?, ?)',
+                (message_id, body, size, time.time()))
+            self._index(message_id, body=body)
+            self._evict_bodies()
+
+    def get_attachments(self, message_id):
+        #attachment list of a message whose body is cached, None when it is not known
+        with self.lock:
+            row = self.conn.execute('SELECT parts FROM attachments WHERE id = ?', (message_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_attachments(self, message_id, attachments):
+        #attachments as listed by mail_attachments.list_attachments, kept as long as the body
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO attachments (id, parts) VALUES (?, ?)',
+                              (message_id, json.dumps(attachments)))
+
+    def _evict_bodies(self):
+        #drop the least recently used bodies until the cache fits in the budget
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM bodies').fetchone()[0]
+        if total <= self.body_budget:
+            return
+        evicted = []
+        for message_id, size in self.conn.execute('SELECT id, size FROM bodies ORDER BY last_access'):
+            if total <= self.body_budget:
+                break
+            evicted.append((message_id,))
+            total -= size
+        self.conn.executemany('DELETE FROM bodies WHERE id = ?', evicted)
+        self.conn.executemany('DELETE FROM attachments WHERE id = ?', evicted)
+
+    def _index(self, message_id, **columns):
+        #update some of the indexed columns of a message, keeping the others
+        if not self.searchable:
+            return
+        self.conn.execute('INSERT OR IGNORE INTO search_docs (id) VALUES (?)', (message_id,))
+        docid = self.conn.execute('SELECT docid FROM search_docs WHERE id = ?', (message_id,)).fetchone()[0]
+        row = self.conn.execute('SELECT subject, sender, body FROM search WHERE rowid = ?', (docid,)).fetchone()
+        values = dict(zip(('subject', 'sender', 'body'), row or ('', '', '')))
+        values.update(columns)
+        if row is not None:
+            self.conn.execute('DELETE FROM search WHERE rowid = ?', (docid,))
+        self.conn.execute('INSERT INTO search (rowid, subject, sender, body) VALUES (?, ?, ?, ?)',
+                          (docid, values['subject'], values['sender'], values['body']))
+
+    def _purge_index(self):
+        #forget the indexed text of messages that left the inbox
+        if not self.searchable:
+            return
+        stale = 'SELECT docid FROM search_docs WHERE id NOT IN (SELECT id FROM messages)'
+        self.conn.execute(f'DELETE FROM search WHERE rowid IN ({stale})')
+        self.conn.execute('DELETE FROM search_docs WHERE id NOT IN (SELECT id FROM messages)')
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        #ids of inbox messages whose subject, sender or body match every word of query, newest first
+        expression = search_expression(query)
+        if not self.searchable or not expression:
+            return []
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                'SELECT m.id FROM search JOIN search_docs d ON d.docid = search.rowid '
+                'JOIN messages m ON m.id = d.id WHERE search MATCH ? ORDER BY m.seq DESC LIMIT ?',
+                (expression, limit))]
+
+    def get_state(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_state(self, key, value):
+        with self.lock, self.conn:
+            if value is None:
+                self.conn.execute('DELETE FROM state WHERE key = ?', (key,))
+            else:
+                self.conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, str(value)))
@@ -0,0 +1,231 @@
+#in-process instrumentation: latency histograms, counters, gauges and cache hit rates
+#operations are timed with timed(), which also logs one json line per operation to the
+#'mail_client' logger; everything recorded can be dumped as json or Prometheus text
+#
+#MAIL_CLIENT_LOG=DEBUG turns on the per-operation log lines
+#MAIL_CLIENT_METRICS=metrics.json (or metrics.prom) names the dump file written by the client
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+#upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+#environment variables read by the client
+LOG_LEVEL_VARIABLE = 'MAIL_CLIENT_LOG'
+DUMP_FILE_VARIABLE = 'MAIL_CLIENT_METRICS'
+
+logger = logging.getLogger('mail_client')
+
+
+def log_event(level, event, **fields):
+    #one json object per line, easy to grep and to load into anything
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps(dict(event=event, **fields), default=str))
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def quantile(self, q):
+        #upper bound of the bucket holding the q quantile, the largest value seen for the last bucket
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.total, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'max': self.max,
+                'buckets': dict(zip((str(bound) for bound in LATENCY_BUCKETS), self.counts))}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        #current value of something that goes up and down
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def cache(self, cache, hit, value=1):
+        #hits and misses of one of the caches, see hit_rates()
+        self.count('cache_hits_total' if hit else 'cache_misses_total', value, cache=cache)
+
+    @contextmanager
+    def timed(self, operation, **fields):
+        #time the block as operation_seconds{operation}, count and log it, errors included
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            elapsed = time.perf_counter() - start
+            self.observe('operation_seconds', elapsed, operation=operation)
+            self.count('operation_errors_total', operation=operation, error=type(e).__name__)
+            log_event(logging.WARNING, operation, ms=round(elapsed * 1000, 1), error=repr(e), **fields)
+            raise
+        elapsed = time.perf_counter() - start
+        self.observe('operation_seconds', elapsed, operation=operation)
+        log_event(logging.DEBUG, operation, ms=round(elapsed * 1000, 1), **fields)
+
+    def hit_rates(self):
+        with self.lock:
+            hits = {dict(labels)['cache']: value for (name, labels), value in self.counters.items()
+                    if name == 'cache_hits_total'}
+            misses = {dict(labels)['cache']: value for (name, labels), value in self.counters.items()
+                      if name == 'cache_misses_total'}
+        return {cache: hits.get(cache, 0) / (hits.get(cache, 0) + misses.get(cache, 0))
+                for cache in sorted(set(hits) | set(misses))}
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value}
+                      for (name, labels), value in sorted(self.gauges.items())]
+            histograms = [{'name': name, 'labels': dict(labels), **histogram.summary()}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        return {'uptime_seconds': time.time() - self.started, 'counters': counters, 'gauges': gauges,
+                'histograms': histograms, 'cache_hit_rates': self.hit_rates()}
+
+    def prometheus_text(self):
+        #text exposition format, one metric family per name
+        lines = []
+        snapshot = self.snapshot()
+        for family in sorted({counter['name'] for counter in snapshot['counters']}):
+            lines.append(f'# TYPE mail_client_{family} counter')
+            for counter in snapshot['counters']:
+                if counter['name'] == family:
+                    lines.append(f"mail_client_{family}{_labels(counter['labels'])} {counter['value']}")
+        for family in sorted({gauge['name'] for gauge in snapshot['gauges']}):
+            lines.append(f'# TYPE mail_client_{family} gauge')
+            for gauge in snapshot['gauges']:
+                if gauge['name'] == family:
+                    lines.append(f"mail_client_{family}{_labels(gauge['labels'])} {gauge['value']}")
+        for family in sorted({histogram['name'] for histogram in snapshot['histograms']}):
+            lines.append(f'# TYPE mail_client_{family} histogram')
+            for histogram in snapshot['histograms']:
+                if histogram['name'] != family:
+                    continue
+                cumulative = 0
+                for bound, count in histogram['buckets'].items():
+                    cumulative += count
+                    le = '+Inf' if bound == 'inf' else bound
+                    lines.append(f"mail_client_{family}_bucket{_labels(dict(histogram['labels'], le=le))} {cumulative}")
+                lines.append(f"mail_client_{family}_sum{_labels(histogram['labels'])} {histogram['sum']}")
+                lines.append(f"mail_client_{family}_count{_labels(histogram['labels'])} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def status_text(self):
+        #short human readable summary for a status panel
+        snapshot = self.snapshot()
+        totals = {}
+        for counter in snapshot['counters']:
+            totals[counter['name']] = totals.get(counter['name'], 0) + counter['value']
+        #api calls, those sent inside a batch counted one by one and the batch itself not at all
+        calls = [counter for counter in snapshot['counters']
+                 if counter['name'] == 'gmail_requests_total' and counter['labels']['method'] != 'batch']
+        failed = sum(counter['value'] for counter in calls if counter['labels']['status'] != 'ok')
+        lines = [f"http requests {totals.get('http_requests_total', 0)}, "
+                 f"{totals.get('http_bytes_received_total', 0) / 1024:.0f} KB down, "
+                 f"{totals.get('http_bytes_sent_total', 0) / 1024:.0f} KB up; "
+                 f"gmail calls {sum(counter['value'] for counter in calls)}, failed {failed}, "
+                 f"retried {totals.get('gmail_retries_total', 0)}"]
+        for histogram in snapshot['histograms']:
+            if histogram['name'] == 'operation_seconds':
+                name = histogram['labels']['operation']
+            elif histogram['name'] == 'gmail_request_seconds':
+                name = 'gmail ' + histogram['labels']['method'].replace('gmail.users.', '')
+            else:
+                continue
+            lines.append(f"{name}: {histogram['count']} x, mean {histogram['mean'] * 1000:.0f} ms, "
+                         f"p95 {histogram['p95'] * 1000:.0f} ms, max {histogram['max'] * 1000:.0f} ms")
+        if snapshot['cache_hit_rates']:
+            lines.append('cache hits: ' + ', '.join(f'{cache} {rate:.0%}'
+                                                    for cache, rate in snapshot['cache_hit_rates'].items()))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        #json unless the file name ends in .prom or .txt, written next to path and moved over it
+        if path.endswith(('.prom', '.txt')):
+            content = self.prometheus_text()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+        partial = path + '.tmp'
+        with open(partial, 'w', encoding='utf-8') as dump_file:
+            dump_file.write(content)
+        os.replace(partial, path)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def configure_logging():
+    #log the client's events to stderr at the level named by MAIL_CLIENT_LOG, warnings only by default
+    #other libraries stay at warnings so their request logging does not drown the events
+    level = os.environ.get(LOG_LEVEL_VARIABLE, 'WARNING').upper()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(name)s %(message)s')
+    logger.setLevel(getattr(logging, level, logging.WARNING))
+
+
+def dump_file():
+    return os.environ.get(DUMP_FILE_VARIABLE)
+
+
+#the metrics of this process, shared by every module
+metrics = Metrics()
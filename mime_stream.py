@@ -0,0 +1,200 @@
+#sending large emails without holding them in memory
+#the MIME message is written part by part to a file, attachments are read and base64 encoded
+#in small chunks, and the file is sent to gmail as a resumable message/rfc822 upload
+#the email.mime classes and the upload machinery are imported on first use, not at startup
+
+import base64
+import io
+import mimetypes
+import os
+import uuid
+from email.header import Header
+from email.utils import encode_rfc2231, formataddr, formatdate, getaddresses, make_msgid
+
+from googleapiclient.errors import HttpError
+
+from rate_limit import QUOTA_UNITS, default_scheduler, is_retryable
+
+
+#emails whose attachments add up to more than this are sent through the resumable upload
+LARGE_MESSAGE_THRESHOLD = 5 * 1024 * 1024
+#bytes of attachment read per step, a multiple of 57 so each step encodes to whole 76 character lines
+READ_CHUNK = 57 * 16 * 1024
+#bytes sent per upload request, gmail wants a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 256 * 1024
+#how many times in a row a failed chunk is resumed before giving up
+MAX_RESUME_ATTEMPTS = 5
+
+CRLF = b'\r\n'
+
+
+def attachments_size(attachments):
+    return sum(os.path.getsize(attachment) for attachment in attachments)
+
+
+def is_large_message(attachments):
+    return attachments_size(attachments) > LARGE_MESSAGE_THRESHOLD
+
+
+def build_raw_message(sender, receiver, subject, body, attachments):
+    #small emails are built in memory and sent as a {'raw': ...} body
+    from email import encoders
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['From'] = encode_addresses(sender)
+    msg['To'] = encode_addresses(receiver)
+    msg.attach(MIMEText(body, 'plain'))
+
+    # attach files to the email
+    for attachment in attachments:
+        part = MIMEBase('application', 'octet-stream')
+        with open(attachment, 'rb') as attachment_file:
+            part.set_payload(attachment_file.read())
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', f'attachment; filename="{os.path.basename(attachment)}"')
+        msg.attach(part)
+
+    return {'raw': base64.urlsafe_b64encode(msg.as_bytes()).decode('utf-8')}
+
+
+def encode_header(value):
+    #non-ascii header values are written as RFC 2047 encoded words
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode()
+
+
+def encode_addresses(value):
+    #only the display names of an address header are encoded, the addresses must stay readable
+    addresses = getaddresses([value])
+    if not any(address for name, address in addresses):
+        return encode_header(value)
+    return ', '.join(formataddr((name, address), 'utf-8') for name, address in addresses if address)
+
+
+def content_disposition(filename):
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*={encode_rfc2231(filename, 'utf-8')}"
+
+
+def write_base64(out, data):
+    #base64 encode data and write it as 76 character lines
+    encoded = base64.b64encode(data)
+    for start in range(0, len(encoded), 76):
+        out.write(encoded[start:start + 76] + CRLF)
+
+
+def new_boundary():
+    return f'===============mailclient{uuid.uuid4().hex}=='
+
+
+def write_head(out, sender, receiver, subject, body, boundary):
+    #the headers of a multipart/mixed email and its text part, up to the first attachment
+    #a line break in a value would start a header of its own, e.g. a Bcc filled in from a csv file
+    for name, value in (('From', sender), ('To', receiver), ('Subject', subject)):
+        if '\r' in value or '\n' in value:
+            raise ValueError(f'line break in the {name} header')
+    headers = [
+        ('From', encode_addresses(sender)),
+        ('To', encode_addresses(receiver)),
+        ('Subject', encode_header(subject)),
+        ('Date', formatdate(localtime=True)),
+        ('Message-ID', make_msgid()),
+        ('MIME-Version', '1.0'),
+        ('Content-Type', f'multipart/mixed; boundary="{boundary}"'),
+    ]
+    for name, value in headers:
+        out.write(f'{name}: {value}'.encode('ascii') + CRLF)
+    out.write(CRLF)
+
+    #the text part
+    out.write(delimiter(boundary))
+    out.write(b'Content-Type: text/plain; charset="utf-8"' + CRLF)
+    out.write(b'Content-Transfer-Encoding: base64' + CRLF + CRLF)
+    write_base64(out, body.encode('utf-8'))
+
+
+def delimiter(boundary):
+    return f'--{boundary}'.encode('ascii') + CRLF
+
+
+def closing_delimiter(boundary):
+    return f'--{boundary}--'.encode('ascii') + CRLF
+
+
+def write_attachment(out, attachment):
+    #headers and base64 body of an attachment part, without the delimiter in front of it
+    #only READ_CHUNK bytes of the file are in memory at any time
+    filename = os.path.basename(attachment)
+    mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    out.write(f'Content-Type: {mime_type}'.encode('ascii') + CRLF)
+    out.write(b'Content-Transfer-Encoding: base64' + CRLF)
+    out.write(f'Content-Disposition: {content_disposition(filename)}'.encode('ascii') + CRLF + CRLF)
+    with open(attachment, 'rb') as attachment_file:
+        while True:
+            data = attachment_file.read(READ_CHUNK)
+            if not data:
+                break
+            write_base64(out, data)
+
+
+def encode_attachment(attachment):
+    #the encoded attachment part as bytes, for emails that all carry the same file
+    out = io.BytesIO()
+    write_attachment(out, attachment)
+    return out.getvalue()
+
+
+def write_message(out, sender, receiver, subject, body, attachments):
+    #write a multipart/mixed email to the binary file object out
+    boundary = new_boundary()
+    write_head(out, sender, receiver, subject, body, boundary)
+
+    # attach files to the email, one chunk at a time
+    for attachment in attachments:
+        out.write(delimiter(boundary))
+        write_attachment(out, attachment)
+
+    out.write(closing_delimiter(boundary))
+
+
+def send_message_stream(service, message_file, progress=None, scheduler=None):
+    #send the message in message_file with a resumable upload
+    #a chunk that fails is resumed from the last byte gmail confirmed instead of starting over
+    #progress, if given, is called with the uploaded fraction after every chunk
+    from googleapiclient.http import MediaIoBaseUpload
+
+    scheduler = scheduler or default_scheduler()
+    scheduler.throttle(QUOTA_UNITS['gmail.users.messages.send'])
+    media = MediaIoBaseUpload(message_file, mimetype='message/rfc822', chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+    request = service.users().messages().send(userId='me', body={}, media_body=media)
+
+    response = None
+    failures = 0
+    while response is None:
+        try:
+            status, response = request.next_chunk(num_retries=3)
+        except (HttpError, ConnectionError, TimeoutError) as e:
+            #4xx other than rate limits mean the upload itself is rejected, resuming will not help
+            if not is_retryable(e):
+                raise
+            failures += 1
+            if failures > MAX_RESUME_ATTEMPTS:
+                raise
+            scheduler.backoff(failures)
+            continue
+
+        failures = 0
+        if status is not None and progress is not None:
+            progress(status.progress())
+
+    return response
@@ -0,0 +1,256 @@
+#central scheduler for Gmail API requests
+#every request is charged its quota units against a token bucket, transient errors
+#(429, userRateLimitExceeded, 5xx, dropped connections) are retried with exponential backoff
+#and jitter, and the number of requests in flight shrinks when gmail starts answering 429
+
+import json
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from metrics import metrics
+
+
+#gmail quota units per method, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.messages.send': 100,
+}
+DEFAULT_UNITS = 5
+#per user limit of gmail
+QUOTA_UNITS_PER_SECOND = 250
+#most requests in flight at once, lowered while gmail rate limits us
+MAX_CONCURRENCY = 8
+#attempts per request before the error is passed on
+MAX_ATTEMPTS = 6
+#backoff before retry n is a random time up to min(BACKOFF_CAP, BACKOFF_BASE * 2 ** n) seconds
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 32
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def request_units(request):
+    return QUOTA_UNITS.get(getattr(request, 'methodId', None), DEFAULT_UNITS)
+
+
+def error_reasons(error):
+    #the "reason" fields of a google api error response
+    try:
+        content = json.loads(error.content.decode('utf-8'))
+        return {detail.get('reason') for detail in content['error'].get('errors', [])}
+    except (ValueError, KeyError, AttributeError, TypeError):
+        return set()
+
+
+def is_rate_limited(error):
+    if not isinstance(error, HttpError):
+        return False
+    return error.resp.status == 429 or (error.resp.status == 403 and bool(error_reasons(error) & RATE_LIMIT_REASONS))
+
+
+def outcome(error):
+    #status label of a finished call for the request counters
+    if error is None:
+        return 'ok'
+    if isinstance(error, HttpError):
+        return str(error.resp.status)
+    return type(error).__name__
+
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRY_STATUSES or is_rate_limited(error)
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    #quota units refill continuously up to one second's worth
+    def __init__(self, units_per_second):
+        self.rate = units_per_second
+        self.tokens = units_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        #block until units are available, a request larger than the bucket waits for a full bucket
+        units = min(units, self.rate)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= units:
+                    self.tokens -= units
+                    return
+                wait_time = (units - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class AdaptiveConcurrency:
+    #limit on requests in flight: halved on every rate limited answer,
+    #raised by one after a run of successful ones as long as the limit
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, rate_limited=False):
+        with self.condition:
+            self.active -= 1
+            if rate_limited:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    def __init__(self, units_per_second=QUOTA_UNITS_PER_SECOND, max_concurrency=MAX_CONCURRENCY,
+                 max_attempts=MAX_ATTEMPTS):
+        self.bucket = TokenBucket(units_per_second)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        #totals since start, for the 429 rate and for debugging
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def throttle(self, units):
+        #charge units without sending anything through the scheduler, e.g. before an upload
+        self.bucket.acquire(units)
+
+    def _count(self, retried=False, rate_limited=False):
+        with self.lock:
+            self.requests += 1
+            self.retries += retried
+            self.rate_limited += rate_limited
+
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+    def execute(self, request, units=None, idempotent=True):
+        #execute a googleapiclient request within quota, retrying transient errors
+        #a request that is not idempotent (a send) is only retried when gmail refused it for the rate,
+        #after a server error it may already have gone through
+        units = units if units is not None else request_units(request)
+        return self.call(request.execute, units, idempotent, getattr(request, 'methodId', None) or 'unknown')
+
+    def call(self, function, units=DEFAULT_UNITS, idempotent=True, method='unknown'):
+        #like execute for a call made some other way, function raises HttpError on an error answer
+        for attempt in range(self.max_attempts):
+            self.bucket.acquire(units)
+            self.concurrency.acquire()
+            start = time.perf_counter()
+            try:
+                result = function()
+            except Exception as e:
+                self._record(method, start, e, attempt)
+                limited = is_rate_limited(e)
+                self.concurrency.release(limited)
+                self._count(retried=attempt > 0, rate_limited=limited)
+                retry = is_retryable(e) if idempotent else limited
+                if not retry or attempt == self.max_attempts - 1:
+                    raise
+                self.backoff(attempt)
+                continue
+            self._record(method, start, None, attempt)
+            self.concurrency.release()
+            self._count(retried=attempt > 0)
+            return result
+
+    def _record(self, method, start, error, attempt, calls=1):
+        metrics.observe('gmail_request_seconds', time.perf_counter() - start, method=method)
+        metrics.count('gmail_requests_total', calls, method=method, status=outcome(error))
+        if attempt > 0:
+            metrics.count('gmail_retries_total', calls, method=method)
+        metrics.gauge('gmail_concurrency_limit', self.concurrency.limit)
+
+    def execute_batch(self, service, requests):
+        #send (request_id, request) pairs as one batch request
+        #inner requests that fail with a transient error are sent again in a smaller batch after a backoff
+        #returns (responses, errors), both dictionaries keyed by request id
+        responses = {}
+        errors = {}
+        pending = list(requests)
+        for attempt in range(self.max_attempts):
+            failed = {}
+
+            def on_response(request_id, response, exception):
+                if exception is not None:
+                    failed[request_id] = exception
+                else:
+                    responses[request_id] = response
+
+            batch = service.new_batch_http_request(callback=on_response)
+            for request_id, request in pending:
+                batch.add(request, request_id=request_id)
+
+            self.bucket.acquire(sum(request_units(request) for request_id, request in pending))
+            self.concurrency.acquire()
+            start = time.perf_counter()
+            try:
+                batch.execute()
+            except Exception as e:
+                #the batch as a whole failed, nothing in it was answered
+                self._record('batch', start, e, attempt)
+                limited = is_rate_limited(e)
+                self.concurrency.release(limited)
+                self._count(retried=attempt > 0, rate_limited=limited)
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    raise
+                self.backoff(attempt)
+                continue
+
+            self._record('batch', start, None, attempt)
+            for request_id, request in pending:
+                error = failed.get(request_id)
+                metrics.count('gmail_requests_total', method=getattr(request, 'methodId', 'unknown'),
+                              status=outcome(error), batched='true')
+            limited = any(is_rate_limited(error) for error in failed.values())
+            self.concurrency.release(limited)
+            self._count(retried=attempt > 0, rate_limited=limited)
+
+            retry = [(request_id, request) for request_id, request in pending
+                     if request_id in failed and is_retryable(failed[request_id])]
+            errors.update((request_id, error) for request_id, error in failed.items())
+            if not retry or attempt == self.max_attempts - 1:
+                break
+            for request_id, request in retry:
+                errors.pop(request_id)
+            pending = retry
+            self.backoff(attempt)
+
+        return responses, errors
+
+
+def default_scheduler():
+    #scheduler shared by everything talking to gmail for the signed in user
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
@@ -0,0 +1,7 @@
+#the client's modules live in the repository root, next to this folder
+#nothing under tests needs wx or the network
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
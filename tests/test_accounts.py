@@ -0,0 +1,100 @@
+import pytest
+
+from accounts import RefreshSchedule, load_accounts, merge_ids, register_account, save_accounts
+
+
+def test_accounts_spread_over_the_interval():
+    schedule = RefreshSchedule(interval=60)
+    schedule.add('a', now=0)
+    schedule.add('b', now=10)
+    assert schedule.due == {'b': 10, 'a': 40}
+    schedule.add('c', now=20)
+    #the newest is due at once, the others follow every interval / 3 seconds in the order they were due
+    assert schedule.due == {'c': 20, 'b': 40, 'a': 60}
+
+
+def test_adding_keeps_a_syncing_account():
+    schedule = RefreshSchedule(interval=60)
+    schedule.add('a', now=0)
+    schedule.start('a')
+    schedule.add('b', now=5)
+    assert schedule.due['a'] == float('inf')
+    assert schedule.due_account(now=5) == 'b'
+
+
+def test_due_account():
+    schedule = RefreshSchedule(interval=60)
+    assert schedule.due_account(now=0) is None
+    schedule.add('a', now=0)
+    schedule.add('b', now=0)
+    assert schedule.due_account(now=0) == 'b'
+    schedule.start('b')
+    assert schedule.due_account(now=0) is None
+    assert schedule.due_account(now=30) == 'a'
+    schedule.start('a')
+    assert schedule.due_account(now=1000) is None
+
+
+def test_quiet_accounts_back_off():
+    schedule = RefreshSchedule(interval=60, max_interval=300)
+    schedule.add('a', now=0)
+    now = 0
+    waits = []
+    for _ in range(5):
+        schedule.start('a')
+        schedule.synced('a', changed=False, now=now)
+        waits.append(schedule.due['a'] - now)
+        now = schedule.due['a']
+    assert waits == [120, 240, 300, 300, 300]
+    schedule.start('a')
+    schedule.synced('a', changed=True, now=now)
+    assert schedule.due['a'] == now + 60
+
+
+def test_removed_account():
+    schedule = RefreshSchedule(interval=60)
+    schedule.add('a', now=0)
+    schedule.start('a')
+    schedule.remove('a')
+    schedule.synced('a', changed=True, now=10)
+    assert schedule.due == {} and schedule.due_account(now=100) is None
+
+
+def test_merge_ids_newest_first():
+    merged = merge_ids({'a': ['1f0', '1a0', '100'], 'b': ['1e0', '1b0', '0f0'], 'c': []})
+    assert merged == [('a', '1f0'), ('b', '1e0'), ('b', '1b0'), ('a', '1a0'), ('a', '100'), ('b', '0f0')]
+
+
+def test_merge_ids_keeps_each_account_order():
+    #ids that are not hex sort as the oldest, each account keeps its own order
+    merged = merge_ids({'a': ['200', 'draft', '100'], 'b': ['150']})
+    assert merged == [('a', '200'), ('b', '150'), ('a', 'draft'), ('a', '100')]
+    assert [key for key in merged if key[0] == 'a'] == [('a', '200'), ('a', 'draft'), ('a', '100')]
+
+
+def test_merge_ids_one_account():
+    assert merge_ids({'a': ['2', '10', '1']}) == [('a', '2'), ('a', '10'), ('a', '1')]
+
+
+@pytest.fixture
+def accounts_file(tmp_path, monkeypatch):
+    #no account.json or token.json of a real client in the working folder
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / 'accounts.json')
+
+
+def test_register_account(accounts_file, monkeypatch, tmp_path):
+    monkeypatch.setattr('accounts.STORE_DIR', str(tmp_path))
+    assert load_accounts(accounts_file) == []
+    first = register_account('a@example.com', accounts_file)
+    second = register_account('b@example.com', accounts_file)
+    assert register_account('a@example.com', accounts_file) == first
+    assert load_accounts(accounts_file) == [('a@example.com', first), ('b@example.com', second)]
+
+
+def test_accounts_of_a_single_account_client(accounts_file, tmp_path):
+    (tmp_path / 'account.json').write_text('{"email": "old@example.com"}')
+    (tmp_path / 'token.json').write_text('{}')
+    assert load_accounts(accounts_file) == [('old@example.com', str(tmp_path / 'token.json'))]
+    save_accounts([('new@example.com', 'new.json')], accounts_file)
+    assert load_accounts(accounts_file) == [('new@example.com', 'new.json')]
@@ -0,0 +1,139 @@
+import base64
+import json
+import mailbox
+import re
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from bulk_export import MboxWriter, checkpoint_path, export_mailbox, load_checkpoint
+from rate_limit import RequestScheduler
+
+
+def raw_message(message_id):
+    #bodies with lines that mbox readers would take for the start of the next message
+    return (f'From: ana@example.com\r\nTo: me@example.com\r\nSubject: Message {message_id}\r\n\r\n'
+            f'Hello,\r\nFrom now on {message_id} is archived.\r\n>From the quoted reply\r\n'
+            f'>>From deeper\r\n From with a space\r\nFromage\r\n').encode('ascii')
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+class FakeRequest:
+    methodId = 'gmail.users.messages.get'
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def execute(self):
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+class FakeService:
+    #messages().list and messages().get(format='raw') over a fixed list of ids
+    def __init__(self, message_ids, failing=()):
+        self.message_ids = list(message_ids)
+        self.failing = set(failing)
+        self.fetched = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, labelIds=None, maxResults=500, pageToken=None, fields=None):
+        start = int(pageToken or 0)
+        page = {'messages': [{'id': message_id} for message_id in self.message_ids[start:start + maxResults]]}
+        if start + maxResults < len(self.message_ids):
+            page['nextPageToken'] = str(start + maxResults)
+        return FakeRequest(page)
+
+    def get(self, userId, id, format=None):
+        self.fetched.append(id)
+        if id in self.failing:
+            return FakeRequest(HttpError(httplib2.Response({'status': 404}), b'{}'))
+        return FakeRequest({'id': id, 'threadId': id, 'labelIds': ['INBOX'], 'internalDate': '1700000000000',
+                            'raw': encode(raw_message(id))})
+
+
+class FakeSession:
+    def __init__(self, service):
+        self.service = service
+
+
+def read_mboxrd(path):
+    #messages of an mboxrd file, with one '>' taken off every escaped From line
+    with open(path, 'rb') as mbox:
+        content = mbox.read()
+    messages = []
+    for chunk in re.split(rb'^From [^\n]*\n', content, flags=re.MULTILINE)[1:]:
+        lines = chunk[:-1].split(b'\n') if chunk.endswith(b'\n\n') else chunk.split(b'\n')
+        messages.append(b'\n'.join(line[1:] if re.match(rb'^>+From ', line) else line for line in lines))
+    return messages
+
+
+def export(tmp_path, service, output_format='mbox'):
+    output = str(tmp_path / f'export.{output_format}')
+    scheduler = RequestScheduler(units_per_second=100000)
+    return output, export_mailbox(FakeSession(service), output, output_format, workers=3, scheduler=scheduler)
+
+
+def test_mboxrd_escaping(tmp_path):
+    path = str(tmp_path / 'one.mbox')
+    writer = MboxWriter(path)
+    writer.write({'raw': encode(raw_message('a')), 'internalDate': '0'})
+    writer.write({'raw': encode(b'Subject: no newline at the end\r\n\r\nFrom here'), 'internalDate': '0'})
+    writer.close()
+    with open(path, 'rb') as mbox:
+        lines = mbox.read().split(b'\n')
+    assert b'>From now on a is archived.' in lines
+    assert b'>>From the quoted reply' in lines
+    assert b'>>>From deeper' in lines
+    assert b' From with a space' in lines and b'Fromage' in lines
+    assert sum(line.startswith(b'From ') for line in lines) == 2
+    assert read_mboxrd(path) == [raw_message('a').replace(b'\r\n', b'\n'),
+                                 b'Subject: no newline at the end\n\nFrom here\n']
+
+
+def test_rerun_skips_exported_messages(tmp_path):
+    message_ids = [f'{index:04x}' for index in range(40, 0, -1)]
+    service = FakeService(message_ids, failing={'0010', '0020'})
+    output, counts = export(tmp_path, service)
+    assert counts == {'exported': 38, 'skipped': 0, 'failed': 2}
+    assert load_checkpoint(checkpoint_path(output, 'mbox')) == set(message_ids) - {'0010', '0020'}
+
+    #the second run fetches only what failed before
+    service.failing.clear()
+    service.fetched.clear()
+    output, counts = export(tmp_path, service)
+    assert counts == {'exported': 2, 'skipped': 38, 'failed': 0}
+    assert sorted(service.fetched) == ['0010', '0020']
+    messages = read_mboxrd(output)
+    assert len(messages) == 40
+    subjects = sorted(re.search(rb'Subject: Message (\w+)', message).group(1).decode('ascii') for message in messages)
+    assert subjects == sorted(message_ids)
+
+    output, counts = export(tmp_path, service)
+    assert counts == {'exported': 0, 'skipped': 40, 'failed': 0}
+
+
+@pytest.mark.parametrize('output_format', ['maildir', 'jsonl'])
+def test_other_formats(tmp_path, output_format):
+    service = FakeService(['0003', '0002', '0001'])
+    output, counts = export(tmp_path, service, output_format)
+    assert counts == {'exported': 3, 'skipped': 0, 'failed': 0}
+    if output_format == 'maildir':
+        messages = [message.as_bytes() for message in mailbox.Maildir(output, create=False)]
+        assert sorted(re.search(rb'Message (\w+)', message).group(1) for message in messages) == \
+            [b'0001', b'0002', b'0003']
+    else:
+        with open(output, encoding='utf-8') as records:
+            ids = [json.loads(line)['id'] for line in records]
+        assert sorted(ids) == ['0001', '0002', '0003']
+    assert load_checkpoint(checkpoint_path(output, output_format)) == {'0001', '0002', '0003'}
@@ -0,0 +1,81 @@
+import base64
+import io
+import json
+
+import pytest
+
+from mail_attachments import list_attachments, write_data_field
+
+
+def response(data, size=None):
+    #an attachments().get answer the way gmail lays it out
+    encoded = base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+    return json.dumps({'size': len(data) if size is None else size, 'data': encoded}, indent=2).encode('ascii')
+
+
+def split(content, *positions):
+    edges = [0, *positions, len(content)]
+    return [content[start:end] for start, end in zip(edges, edges[1:])]
+
+
+def decode(chunks):
+    out = io.BytesIO()
+    write_data_field(chunks, out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('length', [0, 1, 2, 3, 4, 5, 300])
+def test_whole_response(length):
+    data = bytes(range(256)) * 2
+    assert decode([response(data[:length])]) == data[:length]
+
+
+def test_every_split_in_two():
+    #every place the response can be cut, inside "data", the separator, or a base64 quartet
+    data = bytes(range(256))[::-1] * 3
+    content = response(data)
+    for position in range(len(content) + 1):
+        assert decode(split(content, position)) == data, position
+
+
+def test_data_name_over_several_chunks():
+    data = b'\xfb\xff\xfe' * 50
+    content = response(data)
+    start = content.index(b'"data"')
+    assert decode(split(content, start + 1, start + 3, start + 5, start + 7)) == data
+
+
+def test_one_byte_chunks():
+    data = b'attachment bytes \x00\xff' * 20
+    content = response(data)
+    assert decode([content[i:i + 1] for i in range(len(content))]) == data
+
+
+def test_field_after_data_is_ignored():
+    data = b'abcdefg'
+    encoded = base64.urlsafe_b64encode(data).rstrip(b'=')
+    assert decode([b'{"data": "' + encoded + b'", "size": 7}']) == data
+
+
+def test_no_data_field():
+    with pytest.raises(ValueError):
+        decode([b'{"size": 0}'])
+
+
+def test_response_ends_inside_data():
+    content = response(b'x' * 100)
+    with pytest.raises(ValueError):
+        decode([content[:content.index(b'"data"') + 20]])
+
+
+def test_list_attachments():
+    payload = {'mimeType': 'multipart/mixed', 'parts': [
+        {'partId': '0', 'mimeType': 'text/plain', 'filename': '', 'body': {'data': 'aGk'}},
+        {'partId': '1', 'mimeType': 'application/pdf', 'filename': 'a.pdf',
+         'body': {'attachmentId': 'ANGjd', 'size': 2048}},
+        {'partId': '2', 'mimeType': 'text/csv', 'filename': 'b.csv', 'body': {'data': 'YSxi', 'size': 3}},
+    ]}
+    attachments = list_attachments(payload)
+    assert [attachment['part_id'] for attachment in attachments] == ['1', '2']
+    assert attachments[0]['attachment_id'] == 'ANGjd' and 'data' not in attachments[0]
+    assert attachments[1]['data'] == 'YSxi'
@@ -0,0 +1,70 @@
+import base64
+import random
+
+import pytest
+
+from benchmarks.sample_payloads import KINDS, encode, leaf, make_html, make_payload
+from mail_body import extract_body, html_to_text
+
+
+def encode_bytes(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def test_plain_text_preferred_over_html():
+    payload = {'mimeType': 'multipart/alternative',
+               'parts': [leaf('text/html', '<p>html version</p>'), leaf('text/plain', 'plain version')]}
+    assert extract_body(payload) == 'plain version'
+
+
+def test_nested_multipart_mixed():
+    rng = random.Random(1)
+    payload = make_payload('mixed', rng)
+    plain = payload['parts'][0]['parts'][0]
+    assert extract_body(payload) == base64.urlsafe_b64decode(plain['body']['data'] + '==').decode('utf-8')
+
+
+def test_single_part_payload():
+    assert extract_body(leaf('text/plain', 'Здравей,\nкак си?')) == 'Здравей,\nкак си?'
+
+
+def test_html_only():
+    payload = {'mimeType': 'multipart/alternative', 'parts': [leaf('text/html', make_html('first\n\nsecond'))]}
+    #the style sheet in the head is not part of the text
+    assert extract_body(payload) == 'first\n\nsecond'
+
+
+def test_script_and_style_are_dropped():
+    html = ('<html><head><title>Title</title><style>p {color: red}</style></head><body>'
+            '<script>alert("x")</script><p>Hello&nbsp;<b>Ana</b></p><div>Bye &amp; thanks</div>'
+            '<style>.x {}</style></body></html>')
+    assert html_to_text(html) == 'Hello Ana\n\nBye & thanks'
+    assert extract_body(leaf('text/html', html)) == 'Hello Ana\n\nBye & thanks'
+
+
+@pytest.mark.parametrize('charset', ['iso-8859-1', 'windows-1251', 'koi8-r'])
+def test_charset_of_the_part(charset):
+    text = 'caf\xe9' if charset == 'iso-8859-1' else 'Привет'
+    part = {'mimeType': 'text/plain', 'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': f'text/plain; charset={charset}'}],
+            'body': {'data': encode_bytes(text.encode(charset))}}
+    assert extract_body({'mimeType': 'multipart/mixed', 'parts': [part]}) == text
+
+
+def test_unknown_charset_falls_back_to_utf8():
+    part = {'mimeType': 'text/plain', 'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="x-unknown"'}],
+            'body': {'data': encode('naïve')}}
+    assert extract_body(part) == 'naïve'
+
+
+def test_attachments_are_not_the_body():
+    payload = {'mimeType': 'multipart/mixed', 'parts': [leaf('text/plain', 'attached text', filename='notes.txt')]}
+    assert extract_body(payload) == 'No Content'
+    assert extract_body({'mimeType': 'multipart/mixed', 'parts': []}, default='') == ''
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_every_sample_kind_has_text(kind):
+    body = extract_body(make_payload(kind, random.Random(kind), paragraphs=2))
+    assert body and '<' not in body and 'font-family' not in body
@@ -0,0 +1,201 @@
+import csv
+import email
+import io
+import os
+import threading
+
+import pytest
+
+from mail_merge import (SegmentReader, check_fields, load_log, message_segments, read_recipients, render,
+                        send_campaign, single_address)
+from mime_stream import new_boundary, write_head
+from rate_limit import RequestScheduler
+
+
+SEGMENTS = [b'head', b'', b'-', b'shared attachment', b'--end']
+JOINED = b''.join(SEGMENTS)
+
+
+def test_reads_across_segments():
+    reader = SegmentReader(SEGMENTS)
+    assert reader.size == len(JOINED)
+    pieces = []
+    while True:
+        piece = reader.read(3)
+        if not piece:
+            break
+        pieces.append(piece)
+    assert b''.join(pieces) == JOINED
+    assert all(len(piece) == 3 for piece in pieces[:-1])
+
+
+@pytest.mark.parametrize('size', [1, 2, 5, 7, 100])
+def test_every_start_and_size(size):
+    reader = SegmentReader(SEGMENTS)
+    for start in range(len(JOINED) + 1):
+        reader.seek(start)
+        assert reader.read(size) == JOINED[start:start + size]
+        assert reader.tell() == min(len(JOINED), start + size)
+
+
+def test_read_rest():
+    reader = SegmentReader(SEGMENTS)
+    reader.seek(6)
+    assert reader.read() == JOINED[6:]
+    assert reader.read() == b''
+    reader.seek(6)
+    assert reader.read(None) == JOINED[6:]
+
+
+def test_seek_whence():
+    reader = SegmentReader(SEGMENTS)
+    assert reader.seek(-4, os.SEEK_END) == len(JOINED) - 4
+    assert reader.read() == JOINED[-4:]
+    reader.seek(2)
+    assert reader.seek(3, os.SEEK_CUR) == 5
+    assert reader.read(4) == JOINED[5:9]
+    assert reader.seek(-100, os.SEEK_CUR) == 0
+
+
+def test_past_the_end():
+    reader = SegmentReader(SEGMENTS)
+    reader.seek(len(JOINED) + 10)
+    assert reader.read(5) == b''
+
+
+def test_no_segments():
+    reader = SegmentReader([b'', b''])
+    assert reader.size == 0
+    assert reader.read() == b''
+
+
+def test_message_segments_share_the_parts():
+    part = b'Content-Type: text/plain\r\n\r\nattached\r\n'
+    segments = message_segments('me@example.com', 'you@example.com', 'Hi', 'Hello there', [part])
+    assert any(segment is part for segment in segments)
+    message = email.message_from_bytes(b''.join(segments))
+    assert message['To'] == 'you@example.com'
+    assert [item.get_payload(decode=True).strip() for item in message.get_payload()] == [b'Hello there', b'attached']
+
+
+def test_recipients_and_templates(tmp_path):
+    path = tmp_path / 'list.csv'
+    path.write_text('Email, name\nann@example.com, Ann\n,Nobody\nbob@example.com,Bob\n', encoding='utf-8')
+    recipients = read_recipients(str(path))
+    assert [fields['email'] for fields in recipients] == ['ann@example.com', 'bob@example.com']
+    assert render('Hello {name}', recipients[0]) == 'Hello Ann'
+    check_fields(['Hello {name}'], recipients)
+    with pytest.raises(ValueError):
+        check_fields(['Hello {surname}'], recipients)
+
+
+def test_load_log(tmp_path):
+    path = tmp_path / 'list_sent.csv'
+    assert load_log(str(path)) == set()
+    path.write_text('time,email,status,message_id,error\n'
+                    't,ann@example.com,sent,1,\n'
+                    't,bob@example.com,failed,,timeout\n', encoding='utf-8')
+    assert load_log(str(path)) == {'ann@example.com'}
+
+
+class FakeSend:
+    methodId = 'gmail.users.messages.send'
+
+    def __init__(self, service, media_body):
+        self.service = service
+        self.media_body = media_body
+
+    def execute(self):
+        with self.service.lock:
+            self.service.sent.append(self.media_body.getbytes(0, self.media_body.size()))
+            return {'id': f'sent{len(self.service.sent)}'}
+
+
+class FakeService:
+    #stands in for users().messages().send() of the gmail service
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body, media_body):
+        return FakeSend(self, media_body)
+
+
+class FakeSession:
+    def __init__(self):
+        self.service = FakeService()
+
+
+def campaign(tmp_path, recipients, subject='Hi {name}', body='Hello {name}'):
+    session = FakeSession()
+    scheduler = RequestScheduler(units_per_second=100000)
+    log_path = str(tmp_path / 'list_sent.csv')
+    counts = send_campaign(session, 'me@example.com', recipients, subject, body, log_path, workers=2,
+                           scheduler=scheduler)
+    with open(log_path, newline='', encoding='utf-8') as log_file:
+        log = {row['email']: row for row in csv.DictReader(log_file)}
+    return counts, [email.message_from_bytes(raw) for raw in session.service.sent], log
+
+
+def test_line_break_in_a_header_value(tmp_path):
+    recipients = [{'email': 'ann@example.com', 'name': 'Ann\r\nBcc: victim@example.com'},
+                  {'email': 'bob@example.com', 'name': 'Bob'}]
+    counts, messages, log = campaign(tmp_path, recipients)
+    assert counts == {'sent': 1, 'skipped': 0, 'failed': 1}
+    assert [message['To'] for message in messages] == ['bob@example.com']
+    assert all(message['Bcc'] is None for message in messages)
+    assert log['ann@example.com']['status'] == 'failed'
+    with pytest.raises(ValueError):
+        write_head(io.BytesIO(), 'me@example.com', 'you@example.com', 'Hi\nBcc: victim@example.com', '', new_boundary())
+
+
+def test_one_address_per_row(tmp_path):
+    recipients = [{'email': 'a@example.com, b@example.com', 'name': 'Both'},
+                  {'email': 'Carol <carol@example.com>', 'name': 'Carol'}]
+    counts, messages, log = campaign(tmp_path, recipients)
+    assert counts == {'sent': 1, 'skipped': 0, 'failed': 1}
+    assert [message['To'] for message in messages] == ['Carol <carol@example.com>']
+    assert log['a@example.com, b@example.com']['error'] == 'not a single email address'
+
+
+@pytest.mark.parametrize('value, address', [
+    ('ann@example.com', 'ann@example.com'),
+    ('Ann <ann@example.com>', 'ann@example.com'),
+    ('a@example.com, b@example.com', None),
+    ('a@example.com; b@example.com', None),
+    ('a@example.com b@example.com', None),
+    ('ann@example.com\r\nBcc: victim@example.com', None),
+    ('not an address', None),
+    ('@example.com', None),
+])
+def test_single_address(value, address):
+    assert single_address(value) == address
+
+
+def test_progress_can_stop_the_campaign(tmp_path):
+    recipients = [{'email': f'r{index}@example.com', 'name': str(index)} for index in range(50)]
+    session = FakeSession()
+    log_path = str(tmp_path / 'list_sent.csv')
+
+    def stop(counts):
+        if counts['sent'] >= 3:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        send_campaign(session, 'me@example.com', recipients, 'Hi {name}', 'Hello', log_path, workers=2,
+                      scheduler=RequestScheduler(units_per_second=100000), progress=stop)
+    sent = load_log(log_path)
+    assert 3 <= len(sent) < len(recipients)
+    #every email that went out is in the log, so the next run sends each of the others once
+    assert len(session.service.sent) == len(sent)
+    counts = send_campaign(session, 'me@example.com', recipients, 'Hi {name}', 'Hello', log_path, workers=2,
+                           scheduler=RequestScheduler(units_per_second=100000))
+    assert counts == {'sent': len(recipients) - len(sent), 'skipped': len(sent), 'failed': 0}
+    assert sorted(email.message_from_bytes(raw)['To'] for raw in session.service.sent) == \
+        sorted(fields['email'] for fields in recipients)
@@ -0,0 +1,224 @@
+import json
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from gmail_fetch import HistoryExpired, fetch_history_changes
+from mail_sync import full_sync, incremental_sync, load_headers
+from message_store import MessageStore
+from rate_limit import RequestScheduler
+
+
+def http_error(status):
+    content = json.dumps({'error': {'code': status, 'errors': []}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeRequest:
+    def __init__(self, method_id, answer):
+        self.methodId = method_id
+        self.answer = answer
+
+    def execute(self):
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeGmail:
+    #a mailbox whose history is given as pages of history records
+    def __init__(self, inbox_ids=(), history_pages=(), history_id='500', missing=(), expired=False):
+        self.inbox_ids = list(inbox_ids)
+        self.history_pages = list(history_pages)
+        self.history_id = history_id
+        #the start history id is too old, gmail answers history().list with a 404
+        self.expired = expired
+        #ids whose metadata gmail does not return
+        self.missing = set(missing)
+        self.history_calls = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return FakeMessages(self)
+
+    def history(self):
+        return FakeHistory(self)
+
+    def getProfile(self, userId):
+        return FakeRequest('gmail.users.getProfile', {'historyId': self.history_id, 'emailAddress': 'me@example.com'})
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback)
+
+
+class FakeMessages:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId, labelIds=None, maxResults=500, pageToken=None, fields=None):
+        start = int(pageToken or 0)
+        page = {'messages': [{'id': message_id} for message_id in self.gmail.inbox_ids[start:start + maxResults]]}
+        if start + maxResults < len(self.gmail.inbox_ids):
+            page['nextPageToken'] = str(start + maxResults)
+        return FakeRequest('gmail.users.messages.list', page)
+
+    def get(self, userId, id, format=None, metadataHeaders=None):
+        if id in self.gmail.missing:
+            return FakeRequest('gmail.users.messages.get', http_error(404))
+        headers = [{'name': 'Subject', 'value': f'Subject {id}'}, {'name': 'From', 'value': 'ana@example.com'},
+                   {'name': 'Date', 'value': 'Mon, 1 Jan 2024 10:00:00 +0000'}]
+        return FakeRequest('gmail.users.messages.get', {'id': id, 'payload': {'headers': headers}})
+
+
+class FakeHistory:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId, startHistoryId, historyTypes=None, pageToken=None):
+        self.gmail.history_calls.append((startHistoryId, pageToken))
+        if self.gmail.expired:
+            return FakeRequest('gmail.users.history.list', http_error(404))
+        index = int(pageToken or 0)
+        page = dict(self.gmail.history_pages[index])
+        if index + 1 < len(self.gmail.history_pages):
+            page['nextPageToken'] = str(index + 1)
+        return FakeRequest('gmail.users.history.list', page)
+
+
+def added(message_id, *labels):
+    return {'messagesAdded': [{'message': {'id': message_id, 'labelIds': list(labels)}}]}
+
+
+def deleted(message_id):
+    return {'messagesDeleted': [{'message': {'id': message_id}}]}
+
+
+def label_added(message_id, *labels):
+    return {'labelsAdded': [{'message': {'id': message_id}, 'labelIds': list(labels)}]}
+
+
+def label_removed(message_id, *labels):
+    return {'labelsRemoved': [{'message': {'id': message_id}, 'labelIds': list(labels)}]}
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = RequestScheduler(units_per_second=100000)
+    scheduler.backoff = lambda attempt: None
+    return scheduler
+
+
+@pytest.fixture
+def store():
+    store = MessageStore(':memory:')
+    yield store
+    store.close()
+
+
+def test_changes_are_folded_newest_first(scheduler):
+    gmail = FakeGmail(history_pages=[
+        {'history': [added('a', 'INBOX'), added('b', 'INBOX'), added('sent', 'SENT')], 'historyId': '110'},
+        {'history': [label_added('c', 'INBOX'), label_added('d', 'STARRED'), label_removed('e', 'INBOX'),
+                     label_removed('f', 'UNREAD')], 'historyId': '120'},
+        {'history': [deleted('b'), added('g', 'INBOX', 'UNREAD')], 'historyId': '130'},
+    ])
+    added_ids, removed_ids, history_id = fetch_history_changes(gmail, '100', scheduler=scheduler)
+    assert added_ids == ['g', 'c', 'a']
+    assert removed_ids == ['b', 'e']
+    assert history_id == '130'
+    assert gmail.history_calls == [('100', None), ('100', '1'), ('100', '2')]
+
+
+def test_the_last_change_of_a_message_wins(scheduler):
+    gmail = FakeGmail(history_pages=[{'history': [
+        added('a', 'INBOX'), label_removed('a', 'INBOX'),
+        label_removed('b', 'INBOX'), label_added('b', 'INBOX'),
+        added('c', 'INBOX'), deleted('c'),
+    ], 'historyId': '101'}])
+    added_ids, removed_ids, history_id = fetch_history_changes(gmail, '100', scheduler=scheduler)
+    assert added_ids == ['b']
+    assert removed_ids == ['a', 'c']
+
+
+def test_no_changes_keep_the_history_id(scheduler):
+    gmail = FakeGmail(history_pages=[{}])
+    assert fetch_history_changes(gmail, '100', scheduler=scheduler) == ([], [], '100')
+
+
+def test_expired_history(scheduler):
+    gmail = FakeGmail(expired=True)
+    with pytest.raises(HistoryExpired):
+        fetch_history_changes(gmail, '100', scheduler=scheduler)
+
+
+def test_incremental_sync(scheduler, store):
+    store.add_rows([('old2', 'Old 2', 'x', 'd'), ('old1', 'Old 1', 'x', 'd')])
+    gmail = FakeGmail(history_pages=[{'history': [added('new1', 'INBOX'), added('new2', 'INBOX'), deleted('old1'),
+                                                  label_added('old2', 'INBOX')], 'historyId': '140'}])
+    result = incremental_sync(gmail, store, '100', scheduler=scheduler)
+    assert result['full'] is False
+    #a message already in the store is not fetched again
+    assert [row[0] for row in result['rows']] == ['new2', 'new1']
+    assert result['removed_ids'] == ['old1']
+    assert store.get_ids() == ['new2', 'new1', 'old2']
+    assert store.get_headers(['new1'])['new1'][0] == 'Subject new1'
+    assert result['history_id'] == '140' and store.get_state('history_id') == '140'
+
+
+def test_expired_history_falls_back_to_a_full_sync(scheduler, store):
+    store.add_rows([('gone', 'Gone', 'x', 'd')])
+    gmail = FakeGmail(inbox_ids=['c', 'b', 'a'], expired=True, history_id='900')
+    result = incremental_sync(gmail, store, '100', scheduler=scheduler)
+    assert result == {'full': True, 'ids': ['c', 'b', 'a'], 'history_id': '900'}
+    assert store.get_ids() == ['c', 'b', 'a']
+    assert store.get_state('history_id') == '900'
+
+
+def test_failed_headers_clear_the_history_id(scheduler, store):
+    store.set_state('history_id', '100')
+    gmail = FakeGmail(history_pages=[{'history': [added('a', 'INBOX'), added('b', 'INBOX')], 'historyId': '150'}],
+                      missing={'a'})
+    result = incremental_sync(gmail, store, '100', scheduler=scheduler)
+    assert [row[0] for row in result['rows']] == ['b']
+    #the next sync is a full one, which lists the message that could not be loaded
+    assert result['history_id'] is None
+    assert store.get_state('history_id') is None
+
+
+def test_full_sync_lists_every_page(scheduler, store):
+    gmail = FakeGmail(inbox_ids=[f'{index:04x}' for index in range(1200, 0, -1)], history_id='77')
+    pages = []
+    result = full_sync(gmail, store, on_page=pages.append, scheduler=scheduler)
+    assert [len(page) for page in pages] == [500, 500, 200]
+    assert result['ids'] == store.get_ids() and len(result['ids']) == 1200
+    assert store.get_state('history_id') == '77'
+
+
+def test_load_headers(scheduler, store):
+    store.replace_ids(['c', 'b', 'a'])
+    store.put_headers([('c', 'Cached', 'x', 'd')])
+    gmail = FakeGmail(missing={'a'})
+    rows, failed_ids = load_headers(gmail, store, ['c', 'b', 'a'], scheduler=scheduler)
+    assert [row[0] for row in rows] == ['c', 'b']
+    assert rows[0][1] == 'Cached'
+    assert failed_ids == ['a']
+    assert load_headers(None, store, ['c', 'b', 'a']) == ([('c', 'Cached', 'x', 'd'), rows[1]], [])
@@ -0,0 +1,37 @@
+import itertools
+
+import pytest
+
+import message_store
+from message_store import BODY_CACHE_BUDGET, MessageStore, body_budget
+
+
+@pytest.mark.parametrize('value, budget', [
+    (None, BODY_CACHE_BUDGET),
+    ('200', 200 * 1024 * 1024),
+    (' 0.5 ', 512 * 1024),
+    ('0', 0),
+    ('-1', BODY_CACHE_BUDGET),
+    ('lots', BODY_CACHE_BUDGET),
+    ('inf', BODY_CACHE_BUDGET),
+    ('nan', BODY_CACHE_BUDGET),
+])
+def test_body_budget_from_the_environment(monkeypatch, value, budget):
+    if value is None:
+        monkeypatch.delenv('MAIL_CLIENT_BODY_BUDGET', raising=False)
+    else:
+        monkeypatch.setenv('MAIL_CLIENT_BODY_BUDGET', value)
+    assert body_budget() == budget
+
+
+def test_least_recently_used_bodies_are_evicted(monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(message_store.time, 'time', lambda: next(clock))
+    store = MessageStore(':memory:', body_budget=25)
+    store.put_body('a', 'x' * 10)
+    store.put_body('b', 'y' * 10)
+    assert store.get_body('a') == 'x' * 10
+    store.put_body('c', 'z' * 10)
+    assert store.get_body('b') is None
+    assert store.get_body('a') == 'x' * 10 and store.get_body('c') == 'z' * 10
+    store.close()
@@ -0,0 +1,58 @@
+import base64
+import email
+import io
+from email.policy import default
+from email.utils import getaddresses
+
+from mime_stream import build_raw_message, write_message
+
+
+def parse(sender, receiver, subject='Hi', body='Hello', attachments=()):
+    out = io.BytesIO()
+    write_message(out, sender, receiver, subject, body, list(attachments))
+    return out.getvalue(), email.message_from_bytes(out.getvalue(), policy=default)
+
+
+def test_non_ascii_display_names():
+    raw, message = parse('Ана Петрова <ana@example.com>', 'Иван <ivan@example.org>')
+    assert [(address.display_name, address.addr_spec) for address in message['From'].addresses] == \
+        [('Ана Петрова', 'ana@example.com')]
+    assert [(address.display_name, address.addr_spec) for address in message['To'].addresses] == \
+        [('Иван', 'ivan@example.org')]
+    #the raw header still names the address, which is what gmail delivers to
+    to = email.message_from_bytes(raw)['To']
+    assert [address for name, address in getaddresses([to])] == ['ivan@example.org']
+
+
+def test_several_receivers():
+    raw, message = parse('me@example.com', 'Иван <ivan@example.org>, bob@example.com, "Doe, John" <john@example.com>')
+    assert [address.addr_spec for address in message['To'].addresses] == \
+        ['ivan@example.org', 'bob@example.com', 'john@example.com']
+    assert message['To'].addresses[2].display_name == 'Doe, John'
+
+
+def test_plain_addresses_are_kept():
+    raw, message = parse('me@example.com', 'You <you@example.com>')
+    assert b'From: me@example.com\r\n' in raw
+    assert b'To: You <you@example.com>\r\n' in raw
+
+
+def test_subject_body_and_attachment(tmp_path):
+    attachment = tmp_path / 'отчет.bin'
+    data = bytes(range(256)) * 1000
+    attachment.write_bytes(data)
+    raw, message = parse('me@example.com', 'you@example.com', 'Здравей', 'тяло на писмото', [str(attachment)])
+    assert message['Subject'] == 'Здравей'
+    text, part = message.iter_parts()
+    assert text.get_content().strip() == 'тяло на писмото'
+    assert part.get_filename() == 'отчет.bin'
+    assert part.get_content() == data
+
+
+def test_same_addresses_as_the_small_message_path():
+    raw, message = parse('Ана <ana@example.com>', 'Иван <ivan@example.org>')
+    small = build_raw_message('Ана <ana@example.com>', 'Иван <ivan@example.org>', 'Hi', 'Hello', [])
+    other = email.message_from_bytes(base64.urlsafe_b64decode(small['raw']), policy=default)
+    for name in ('From', 'To'):
+        assert [address.addr_spec for address in message[name].addresses] == \
+            [address.addr_spec for address in other[name].addresses]
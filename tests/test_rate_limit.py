@@ -0,0 +1,129 @@
+import json
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from rate_limit import RequestScheduler, is_rate_limited, is_retryable
+
+
+def http_error(status, reason=None):
+    errors = [{'reason': reason}] if reason else []
+    content = json.dumps({'error': {'code': status, 'errors': errors}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeRequest:
+    methodId = 'gmail.users.messages.get'
+
+    def __init__(self, answers):
+        #what each attempt at this request gets: an exception or a response
+        self.answers = list(answers)
+        self.sent = 0
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.batches.append([request_id for request_id, request in self.requests])
+        if self.service.batch_errors:
+            raise self.service.batch_errors.pop(0)
+        for request_id, request in self.requests:
+            answer = request.answers[min(request.sent, len(request.answers) - 1)]
+            request.sent += 1
+            if isinstance(answer, Exception):
+                self.callback(request_id, None, answer)
+            else:
+                self.callback(request_id, answer, None)
+
+
+class FakeService:
+    def __init__(self, batch_errors=()):
+        self.batches = []
+        self.batch_errors = list(batch_errors)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = RequestScheduler(units_per_second=10000, max_attempts=4)
+    scheduler.backoff = lambda attempt: None
+    return scheduler
+
+
+def test_retries_only_the_transient_failures(scheduler):
+    not_found = http_error(404)
+    requests = [
+        ('ok', FakeRequest([{'id': 'ok'}])),
+        ('limited', FakeRequest([http_error(429), {'id': 'limited'}])),
+        ('busy', FakeRequest([http_error(503), http_error(500), {'id': 'busy'}])),
+        ('missing', FakeRequest([not_found])),
+    ]
+    service = FakeService()
+    responses, errors = scheduler.execute_batch(service, requests)
+    assert responses == {'ok': {'id': 'ok'}, 'limited': {'id': 'limited'}, 'busy': {'id': 'busy'}}
+    assert errors == {'missing': not_found}
+    assert service.batches == [['ok', 'limited', 'busy', 'missing'], ['limited', 'busy'], ['busy']]
+    assert scheduler.retries == 2 and scheduler.rate_limited == 1
+
+
+def test_gives_up_after_the_last_attempt(scheduler):
+    service = FakeService()
+    responses, errors = scheduler.execute_batch(service, [('a', FakeRequest([{}])), ('b', FakeRequest([http_error(500)]))])
+    assert responses == {'a': {}}
+    assert list(errors) == ['b'] and errors['b'].resp.status == 500
+    assert len(service.batches) == scheduler.max_attempts
+
+
+def test_rate_limited_answer_lowers_concurrency(scheduler):
+    limit = scheduler.concurrency.limit
+    scheduler.execute_batch(FakeService(), [('a', FakeRequest([http_error(403, 'userRateLimitExceeded'), {}]))])
+    assert scheduler.concurrency.limit == limit // 2
+
+
+def test_failed_batch_is_sent_again(scheduler):
+    service = FakeService(batch_errors=[ConnectionError('reset')])
+    responses, errors = scheduler.execute_batch(service, [('a', FakeRequest([{'id': 'a'}]))])
+    assert responses == {'a': {'id': 'a'}} and errors == {}
+    assert service.batches == [['a'], ['a']]
+
+
+def test_failed_batch_that_is_not_transient(scheduler):
+    service = FakeService(batch_errors=[http_error(400)])
+    with pytest.raises(HttpError):
+        scheduler.execute_batch(service, [('a', FakeRequest([{}]))])
+    assert len(service.batches) == 1
+
+
+def test_transient_errors():
+    assert is_retryable(http_error(429)) and is_rate_limited(http_error(429))
+    assert is_retryable(http_error(403, 'rateLimitExceeded')) and is_rate_limited(http_error(403, 'rateLimitExceeded'))
+    assert is_retryable(http_error(502)) and not is_rate_limited(http_error(502))
+    assert not is_retryable(http_error(403, 'insufficientPermissions'))
+    assert not is_retryable(http_error(404))
+    assert is_retryable(TimeoutError()) and not is_retryable(ValueError())
+
+
+def test_send_is_retried_only_when_rate_limited(scheduler):
+    answers = [http_error(429), http_error(503), 'sent']
+    calls = []
+
+    def send():
+        calls.append(1)
+        answer = answers[len(calls) - 1]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    with pytest.raises(HttpError) as error:
+        scheduler.call(send, idempotent=False)
+    assert error.value.resp.status == 503 and len(calls) == 2